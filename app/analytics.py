@@ -0,0 +1,184 @@
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional
+from uuid import UUID
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .models import JournalEntry, MoodDailyRollup, UserMoodStats, utcnow
+
+# Rollups are maintained from crud's journal writes inside the same transaction,
+# so dashboard reads never have to scan journal_entries. The rows are read with
+# FOR UPDATE: journals for the same user can be written at once by the scheduler,
+# /journal/generate_missing and other workers, and the increments below must not
+# overwrite each other.
+
+def _journal_day(journal_entry: JournalEntry) -> date:
+    return (journal_entry.create_time or utcnow()).date()
+
+def _normalize_mood(mood: Optional[str]) -> Optional[str]:
+    return mood.strip().lower() if mood and mood.strip() else None
+
+def _get_locked(db: Session, model, key, create):
+    db.flush()
+    instance = db.get(model, key, with_for_update=True, populate_existing=True)
+    if instance is not None:
+        return instance
+
+    try:
+        with db.begin_nested():
+            instance = create()
+            db.add(instance)
+    except IntegrityError:
+        # Another transaction created the row first, wait for its lock
+        instance = db.get(model, key, with_for_update=True, populate_existing=True)
+    return instance
+
+def _get_rollup(db: Session, user_id: UUID, day: date) -> MoodDailyRollup:
+    return _get_locked(
+        db, MoodDailyRollup, (user_id, day),
+        lambda: MoodDailyRollup(uid=user_id, day=day, journal_count=0, sentiment_sum=0.0, sentiment_count=0, mood_counts={})
+    )
+
+def _get_stats(db: Session, user_id: UUID) -> UserMoodStats:
+    return _get_locked(
+        db, UserMoodStats, user_id,
+        lambda: UserMoodStats(uid=user_id, total_journals=0, current_streak=0, longest_streak=0)
+    )
+
+def _adjust(rollup: MoodDailyRollup, mood: Optional[str], sentiment_score: Optional[float], sign: int):
+    if sentiment_score is not None:
+        rollup.sentiment_sum += sign * sentiment_score
+        rollup.sentiment_count += sign
+
+    mood = _normalize_mood(mood)
+    if mood:
+        # Reassign so the JSON column is flagged dirty
+        mood_counts = dict(rollup.mood_counts or {})
+        mood_counts[mood] = mood_counts.get(mood, 0) + sign
+        if mood_counts[mood] <= 0:
+            del mood_counts[mood]
+        rollup.mood_counts = mood_counts
+
+def _streaks(days: Iterable[date]):
+    current = longest = 0
+    last_day = None
+    for day in days:
+        current = current + 1 if last_day is not None and day == last_day + timedelta(days=1) else 1
+        longest = max(longest, current)
+        last_day = day
+    return current, longest, last_day
+
+def _recompute_streaks(db: Session, stats: UserMoodStats):
+    # Only needed for backdated inserts and deletes that empty a day, both rare
+    db.flush()
+    days = (
+        db.query(MoodDailyRollup.day)
+        .filter(MoodDailyRollup.uid == stats.uid, MoodDailyRollup.journal_count > 0)
+        .order_by(MoodDailyRollup.day)
+    )
+    stats.current_streak, stats.longest_streak, stats.last_day = _streaks(row.day for row in days)
+
+def journal_added(db: Session, journal_entry: JournalEntry):
+    day = _journal_day(journal_entry)
+    rollup = _get_rollup(db, journal_entry.uid, day)
+    rollup.journal_count += 1
+    _adjust(rollup, journal_entry.mood, journal_entry.sentiment_score, 1)
+
+    stats = _get_stats(db, journal_entry.uid)
+    stats.total_journals += 1
+    if rollup.journal_count > 1:
+        return
+
+    if stats.last_day is None or day > stats.last_day:
+        stats.current_streak = stats.current_streak + 1 if stats.last_day == day - timedelta(days=1) else 1
+        stats.longest_streak = max(stats.longest_streak, stats.current_streak)
+        stats.last_day = day
+    else:
+        _recompute_streaks(db, stats)
+
+def journal_changed(db: Session, journal_entry: JournalEntry, old_mood: Optional[str], old_sentiment_score: Optional[float]):
+    rollup = _get_rollup(db, journal_entry.uid, _journal_day(journal_entry))
+    _adjust(rollup, old_mood, old_sentiment_score, -1)
+    _adjust(rollup, journal_entry.mood, journal_entry.sentiment_score, 1)
+
+def journal_removed(db: Session, journal_entry: JournalEntry):
+    rollup = _get_rollup(db, journal_entry.uid, _journal_day(journal_entry))
+    rollup.journal_count -= 1
+    _adjust(rollup, journal_entry.mood, journal_entry.sentiment_score, -1)
+
+    stats = _get_stats(db, journal_entry.uid)
+    stats.total_journals = max(stats.total_journals - 1, 0)
+    if rollup.journal_count <= 0:
+        # Also drops a row just created for a journal that predates the rollups
+        db.delete(rollup)
+        _recompute_streaks(db, stats)
+
+def rebuild_user_rollups(db: Session, user_id: UUID, batch_size: int = 1000):
+    """Recomputes a user's rollups from journal_entries; used for backfills and repairs."""
+    days: Dict[date, MoodDailyRollup] = {}
+    journals = (
+        db.query(JournalEntry.create_time, JournalEntry.mood, JournalEntry.sentiment_score)
+        .filter(JournalEntry.uid == user_id)
+        .yield_per(batch_size)
+    )
+    for create_time, mood, sentiment_score in journals:
+        day = create_time.date()
+        if day not in days:
+            days[day] = MoodDailyRollup(uid=user_id, day=day, journal_count=0, sentiment_sum=0.0, sentiment_count=0, mood_counts={})
+        days[day].journal_count += 1
+        _adjust(days[day], mood, sentiment_score, 1)
+
+    db.query(MoodDailyRollup).filter(MoodDailyRollup.uid == user_id).delete(synchronize_session=False)
+    db.add_all(days.values())
+
+    stats = _get_stats(db, user_id)
+    stats.total_journals = sum(rollup.journal_count for rollup in days.values())
+    stats.current_streak, stats.longest_streak, stats.last_day = _streaks(sorted(days))
+    db.commit()
+    return len(days)
+
+def get_trends(db: Session, user_id: UUID, start: date, end: date, granularity: str = "day"):
+    rollups: List[MoodDailyRollup] = (
+        db.query(MoodDailyRollup)
+        .filter(MoodDailyRollup.uid == user_id, MoodDailyRollup.day >= start, MoodDailyRollup.day <= end)
+        .order_by(MoodDailyRollup.day)
+        .all()
+    )
+
+    buckets = {}
+    distribution = defaultdict(int)
+    for rollup in rollups:
+        bucket_start = rollup.day - timedelta(days=rollup.day.weekday()) if granularity == "week" else rollup.day
+        bucket = buckets.setdefault(bucket_start, {"start": bucket_start, "journal_count": 0, "sentiment_sum": 0.0, "sentiment_count": 0, "mood_counts": defaultdict(int)})
+        bucket["journal_count"] += rollup.journal_count
+        bucket["sentiment_sum"] += rollup.sentiment_sum
+        bucket["sentiment_count"] += rollup.sentiment_count
+        for mood, count in (rollup.mood_counts or {}).items():
+            bucket["mood_counts"][mood] += count
+            distribution[mood] += count
+
+    stats = db.get(UserMoodStats, user_id)
+    current_streak = 0
+    if stats and stats.last_day and stats.last_day >= utcnow().date() - timedelta(days=1):
+        # A streak is still alive if the last journal was today or yesterday
+        current_streak = stats.current_streak
+
+    return {
+        "start": start,
+        "end": end,
+        "granularity": granularity,
+        "buckets": [
+            {
+                "start": bucket["start"],
+                "journal_count": bucket["journal_count"],
+                "average_sentiment": bucket["sentiment_sum"] / bucket["sentiment_count"] if bucket["sentiment_count"] else None,
+                "mood_counts": dict(bucket["mood_counts"]),
+            } for bucket in buckets.values()
+        ],
+        "mood_distribution": dict(distribution),
+        "current_streak": current_streak,
+        "longest_streak": stats.longest_streak if stats else 0,
+        "total_journals": stats.total_journals if stats else 0,
+    }
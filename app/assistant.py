@@ -1,4 +1,5 @@
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
 from langchain_ollama import ChatOllama, OllamaEmbeddings
 from langchain_community.document_loaders import PyPDFLoader
@@ -7,15 +8,79 @@ from langchain_community.vectorstores import FAISS
 from langgraph.graph import StateGraph, START, END
 from langchain_core.output_parsers import StrOutputParser
 
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List, Dict, TypedDict
+from time import perf_counter
+from typing import Awaitable, Callable, List, Dict, Optional, Tuple, TypedDict
 
-import os, logging, json, dotenv
+import asyncio, os, logging, json, dotenv
+
+from pydantic import ValidationError
+
+from .lifecycle import HostSlots, host_slots_from_env
+from .metrics import LLM_ACTIVE, LLM_QUEUE_DEPTH, LLM_QUEUE_WAIT, RETRIEVAL_LATENCY, host_llm_load
+from .schemas import JournalNarrative, JournalSummary
+from .tracing import LLMSpanHandler, TracedEmbeddings, tracer
 
 logger = logging.getLogger("assistant")
 dotenv.load_dotenv()
 ollama_url = os.getenv("OLLAMA_URL")
 
+class LLMLimiter:
+    """
+    Bounds concurrent generations against the model server and keeps track of
+    the queue in front of it, so waiting time is visible instead of hidden in Ollama.
+    With several workers a generation also needs one of the host wide slots, so the
+    budget holds for the whole host rather than per process.
+    """
+    def __init__(self, max_concurrency: int, host_slots: Optional[HostSlots] = None):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.host_slots = host_slots
+        self.waiting = 0
+        self.active = 0
+
+    @asynccontextmanager
+    async def slot(self, kind: str = "chat"):
+        start = perf_counter()
+        self.waiting += 1
+        LLM_QUEUE_DEPTH.inc()
+        host_slot = None
+        try:
+            await self.semaphore.acquire()
+            if self.host_slots:
+                try:
+                    host_slot = await self.host_slots.acquire()
+                except BaseException:
+                    self.semaphore.release()
+                    raise
+        finally:
+            self.waiting -= 1
+            LLM_QUEUE_DEPTH.dec()
+
+        LLM_QUEUE_WAIT.labels(kind).observe(perf_counter() - start)
+        self.active += 1
+        LLM_ACTIVE.inc()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            LLM_ACTIVE.dec()
+            if host_slot is not None:
+                self.host_slots.release(host_slot)
+            self.semaphore.release()
+
+    def load(self) -> Tuple[float, float]:
+        """
+        Waiting and active generations on the whole host. Background jobs run in one
+        worker but have to yield to chat in all of them.
+        """
+        return host_llm_load() or (self.waiting, self.active)
+
+# LLM_MAX_CONCURRENCY is the budget for the whole host, production mode shares it between
+# workers through the slot files under LLM_SLOT_DIR
+LLM_MAX_CONCURRENCY = max(int(os.getenv("LLM_MAX_CONCURRENCY", "4")), 1)
+llm_limiter = LLMLimiter(LLM_MAX_CONCURRENCY, host_slots_from_env(LLM_MAX_CONCURRENCY))
+
 class DocumentManager:
     def __init__(self):
         self.text_splitter = RecursiveCharacterTextSplitter(
@@ -59,7 +124,7 @@ class DocumentManager:
 
 
 class VectorStoreManager:
-    def __init__(self, embeddings: OllamaEmbeddings, docs_dir: Path = Path("../documents/"), persist_dir: Path = Path("../faiss/")) -> None:
+    def __init__(self, embeddings: Embeddings, docs_dir: Path = Path("../documents/"), persist_dir: Path = Path("../faiss/")) -> None:
         self.embeddings = embeddings
         self.vector_store = None
         self.docs_dir = docs_dir
@@ -117,11 +182,13 @@ class Assistant:
             model=model_name,
             temperature=0.9,
             num_ctx=2048,
+            callbacks=[LLMSpanHandler()],
         )
-        self.embeddings = OllamaEmbeddings(
+        self.embeddings = TracedEmbeddings(OllamaEmbeddings(
+            base_url=ollama_url,
             model=embeddings,
-        )
-        self.retriever = VectorStoreManager(self.embeddings, Path("./documents"), Path("./faiss")).get_retriever()
+        ))
+        self.retriever = VectorStoreManager(self.embeddings, Path("./documents"), Path(os.getenv("FAISS_DIR", "./faiss"))).get_retriever()
         self.prompt = PromptTemplate.from_template("""
         You are an mental health assistant who is chatting with a human to resolve there mental issues, anixety etc. 
         Use the following pieces of retrieved context to answer the question if it is relevant for answering the question in few understandable sentences.
@@ -151,14 +218,18 @@ class Assistant:
         self.workflow = workflow.compile()
 
     def retrieve(self, state: ConversationState) -> ConversationState:
-        print("--RETRIEVE--")
+        logger.debug("node=retrieve question_len=%d", len(state['question']))
         question = state['question']
-        state['retrieved_docs'] = self.retriever.invoke(question)
+        start = perf_counter()
+        with tracer.start_as_current_span("graph.retrieve") as span:
+            state['retrieved_docs'] = self.retriever.invoke(question)
+            span.set_attribute("retrieval.documents", len(state['retrieved_docs']))
+        RETRIEVAL_LATENCY.observe(perf_counter() - start)
 
         return state
 
     async def generate(self, state: ConversationState) -> ConversationState:
-        print("--GENERATE--")
+        logger.debug("node=generate history_len=%d", len(state['conversation_history']))
         question = state['question']
         docs = state['retrieved_docs']
         conversation_history = state['conversation_history']
@@ -168,69 +239,168 @@ class Assistant:
             return "\n\n".join(doc.page_content for doc in docs)
 
         def format_history(history):
-            return "\n".join(f"{msg['role']}: {msg["content"]}" for msg in history)
+            return "\n".join(f"{msg['role']}: {msg['content']}" for msg in history)
 
         rag_chain = self.prompt | self.llm | StrOutputParser()
 
-        response = await rag_chain.ainvoke({
-            "chat_history": format_history(conversation_history), 
-            "long_term_memory": "",
-            "context": format_docs(docs), 
-            "question": question
-        })
+        with tracer.start_as_current_span("graph.generate") as span:
+            span.set_attribute("chat.history_messages", len(conversation_history))
+            span.set_attribute("chat.context_documents", len(docs))
+            response = await rag_chain.ainvoke({
+                "chat_history": format_history(conversation_history), 
+                "long_term_memory": "",
+                "context": format_docs(docs), 
+                "question": question
+            })
         state["generation"] = response
 
         return state
 
+JOURNAL_MAX_ATTEMPTS = int(os.getenv("JOURNAL_MAX_ATTEMPTS", "2"))
+JOURNAL_RETRY_MAX_CHARS = int(os.getenv("JOURNAL_RETRY_MAX_CHARS", "6000"))
+
 class JournalMaker:
-    def __init__(self, model_name="hf.co/prithivMLmods/Llama-Chat-Summary-3.2-3B-GGUF:Q8_0") -> None:
+    def __init__(self, model_name="hf.co/prithivMLmods/Llama-Chat-Summary-3.2-3B-GGUF:Q8_0", structured: bool = True) -> None:
         self.llm = ChatOllama(
             base_url=ollama_url,
             model=model_name,
             temperature=0.9,
             num_ctx=4096,
+            callbacks=[LLMSpanHandler()],
         )
-        self.prompt_template = ChatPromptTemplate.from_messages(["system", """
-            Analyze the following conversation between an 
-            MindPal mental health AI assistant and a user.
-
-            1. Generate a journal entry summarizing the conversation.
-            2. Identify the user's overall mood based on their words, tone, and emotions.
-            3. Assign a sentiment score between -1.0 (very negative) to 1.0 (very positive), with 0.0 as neutral.
-
-            Return using JSON only
-            journal_content: <Generated summary>
-            mood: <One-word Mood>
-            sentiment_score: <Decimal score>""", 
-            ("human", "{chat_history}")
-        ])
+        # Grammar constrained decoding: Ollama only emits tokens that fit the schema.
+        # Keyed by with_metadata; without it the model only writes the narrative and
+        # mood/sentiment come from the local scorer.
+        self.schemas = {True: JournalSummary, False: JournalNarrative}
+        self.structured_llms = {
+            with_metadata: self.llm.bind(format=schema.model_json_schema()) if structured else self.llm
+            for with_metadata, schema in self.schemas.items()
+        }
 
-    def summarize(self, chat_history: str):
-        chain = self.prompt_template | self.llm
+        self.prompt_templates = {
+            True: ChatPromptTemplate.from_messages([
+                ("system", """
+                Analyze the following conversation between an 
+                MindPal mental health AI assistant and a user.
+
+                1. Generate a journal entry summarizing the conversation.
+                2. Identify the user's overall mood based on their words, tone, and emotions.
+                3. Assign a sentiment score between -1.0 (very negative) to 1.0 (very positive), with 0.0 as neutral.
+
+                Return using JSON only
+                journal_content: <Generated summary>
+                mood: <One-word Mood>
+                sentiment_score: <Decimal score>"""),
+                ("human", "{chat_history}")
+            ]),
+            False: ChatPromptTemplate.from_messages([
+                ("system", """
+                Analyze the following conversation between an 
+                MindPal mental health AI assistant and a user.
+
+                Generate a journal entry summarizing the conversation.
+
+                Return using JSON only
+                journal_content: <Generated summary>"""),
+                ("human", "{chat_history}")
+            ]),
+        }
+        # Shorter prompts over a truncated history for retries after an unusable response
+        self.retry_prompt_templates = {
+            True: ChatPromptTemplate.from_messages([
+                ("system", "Summarize the conversation as a JSON object with keys journal_content (string), "
+                           "mood (one word) and sentiment_score (number from -1.0 to 1.0). Output JSON only."),
+                ("human", "{chat_history}")
+            ]),
+            False: ChatPromptTemplate.from_messages([
+                ("system", "Summarize the conversation as a JSON object with the key journal_content (string). Output JSON only."),
+                ("human", "{chat_history}")
+            ]),
+        }
 
-        def format_history(history):
-            return "\n".join(f"{msg.role}: {msg.content}" for msg in history)
- 
-        logger.info("Journal creation invoked")
+    @staticmethod
+    def format_history(history, max_chars: int = None) -> str:
+        text = "\n".join(f"{msg.role}: {msg.content}" for msg in history)
+        if max_chars and len(text) > max_chars:
+            # Keep the end of the conversation, it carries the user's latest state
+            text = text[-max_chars:]
+        return text
+
+    @staticmethod
+    def parse(content: str, schema=JournalSummary) -> Optional[JournalNarrative]:
+        """Parses the model output, tolerating markdown fences and prose around the JSON object."""
+        candidates = [content]
+        start, end = content.find("{"), content.rfind("}")
+        if start != -1 and end > start:
+            candidates.append(content[start:end + 1])
+
+        for candidate in candidates:
+            try:
+                return schema.model_validate(json.loads(candidate))
+            except (ValueError, ValidationError):
+                continue
+        return None
+
+    def _attempt(self, attempt: int, chat_history, with_metadata: bool):
+        if attempt == 0:
+            prompt, history = self.prompt_templates[with_metadata], self.format_history(chat_history)
+        else:
+            prompt, history = self.retry_prompt_templates[with_metadata], self.format_history(chat_history, JOURNAL_RETRY_MAX_CHARS)
+        return prompt | self.structured_llms[with_metadata], {"chat_history": history}
 
-        try:
-            response = chain.invoke(input=format_history(chat_history))
+    def _result(self, summary: Optional[JournalNarrative]) -> Tuple[Optional[str], Optional[str], Optional[float]]:
+        if summary is None:
+            logger.error("Failed to generate a parsable journal after %d attempts", JOURNAL_MAX_ATTEMPTS)
+            return None, None, None
 
-            response_json = json.loads(response.content)
+        mood = getattr(summary, "mood", None)
+        sentiment_score = getattr(summary, "sentiment_score", None)
+        logger.debug("Generated journal length=%d mood=%s sentiment=%s", len(summary.journal_content), mood, sentiment_score)
+        return summary.journal_content, mood, sentiment_score
 
-            journal_content = response_json.get("journal_content", "").strip()
-            mood = response_json.get("mood", "").strip()
-            sentiment_score = response_json.get("sentiment_score", 0.0)
+    def summarize(self, chat_history, with_metadata: bool = True):
+        """
+        Returns (journal_content, mood, sentiment_score). With `with_metadata=False`
+        only the narrative is generated and mood/sentiment_score are None.
+        """
+        logger.info("Journal creation invoked")
 
-            logger.info(f"Generated Journal: {journal_content}, Mood: {mood}, Sentiment: {sentiment_score}")
-            return journal_content, mood, sentiment_score
+        summary = None
+        for attempt in range(JOURNAL_MAX_ATTEMPTS):
+            chain, inputs = self._attempt(attempt, chat_history, with_metadata)
+            try:
+                summary = self.parse(chain.invoke(inputs).content, self.schemas[with_metadata])
+            except Exception as e:
+                logger.error(f"Unexpected error during journal generation: {e}")
+                return None, None, None
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Error parsing JSON response: {e}")
-            return None, None, None
-        except Exception as e:
-            logger.error(f"Unexpected error during journal generation: {e}")
-            return None, None, None
+            if summary:
+                break
+            logger.warning("attempt=%d journal response was not valid JSON", attempt + 1)
 
+        return self._result(summary)
 
+    async def asummarize(self, chat_history, with_metadata: bool = True, on_chunk: Optional[Callable[[str], Awaitable[None]]] = None):
+        """Async variant of `summarize` that streams the raw output to `on_chunk` as it is generated."""
+        logger.info("Journal creation invoked")
 
+        summary = None
+        async with llm_limiter.slot("journal"):
+            for attempt in range(JOURNAL_MAX_ATTEMPTS):
+                chain, inputs = self._attempt(attempt, chat_history, with_metadata)
+                content = ""
+                try:
+                    async for chunk in chain.astream(inputs):
+                        content += chunk.content
+                        if on_chunk and chunk.content:
+                            await on_chunk(chunk.content)
+                except Exception as e:
+                    logger.error(f"Unexpected error during journal generation: {e}")
+                    return None, None, None
+
+                summary = self.parse(content, self.schemas[with_metadata])
+                if summary:
+                    break
+                logger.warning("attempt=%d journal response was not valid JSON", attempt + 1)
+
+        return self._result(summary)
@@ -5,7 +5,9 @@ from typing import Optional, Dict
 
 from sqlalchemy.orm import Session
 
-from .crud import create_conversation, create_message, get_conversation_history
+from .crud import create_conversation, create_message, get_conversation_history, get_conversation_update_time
+from .metrics import CONV_CACHE_LOOKUPS
+from .tracing import tracer
 
 class ConvManager:
     def __init__(self, ttl: int = 1800, max_size: int = 100):
@@ -13,10 +15,12 @@ class ConvManager:
         self.lock = Lock()
 
     def start_conversation(self, user_id: UUID, db: Session):
-        conversation_id = create_conversation(db, user_id).id
+        conversation = create_conversation(db, user_id)
+        conversation_id = conversation.id
 
         state = {
             "user_id": user_id,
+            "update_time": conversation.update_time,
             "conversation_history": [],
             "question": "",
             "retrieved_docs": [],
@@ -29,17 +33,33 @@ class ConvManager:
         return conversation_id
 
     def get_conversation(self, user_id: UUID, conversation_id: UUID, db: Session) -> Optional[Dict]:
+        with tracer.start_as_current_span("conv_manager.get_conversation") as span:
+            return self._get_conversation(user_id, conversation_id, db, span)
+
+    def _get_conversation(self, user_id: UUID, conversation_id: UUID, db: Session, span) -> Optional[Dict]:
+        # With several workers another process may have added messages since this
+        # state was cached; update_time tells, and it also checks the owner
+        update_time = get_conversation_update_time(db, conversation_id, user_id)
+        if update_time is None:
+            return None
+
         with self.lock:
-            if conversation_id in self.active_conversations:
-                return self.active_conversations[conversation_id]
+            state = self.active_conversations.get(conversation_id)
+            if state is not None and state.get("user_id") == user_id and state.get("update_time") == update_time:
+                CONV_CACHE_LOOKUPS.labels("hit").inc()
+                span.set_attribute("cache.hit", True)
+                return state
 
+        CONV_CACHE_LOOKUPS.labels("miss").inc()
+        span.set_attribute("cache.hit", False)
         conversation_history = get_conversation_history(db, conversation_id, user_id)
-
         if conversation_history is None:
+            # Deleted between the two lookups
             return None
 
         state = {
             "user_id": user_id,
+            "update_time": update_time,
             "conversation_history": [
                 {
                     "role": msg.role,
@@ -65,9 +85,23 @@ class ConvManager:
                         "content": content
                     }
                 )
-        create_message(db, conversation_id, role, content)
+        message = create_message(db, conversation_id, role, content)
+
+        with self.lock:
+            if conversation_id in self.active_conversations:
+                self.active_conversations[conversation_id]["update_time"] = message.create_time
+
+    def keep_alive(self, conversation_id: UUID, state: Dict):
+        with self.lock:
+            self.active_conversations[conversation_id] = state
 
     def end_coversation(self, conversation_id: UUID):
         with self.lock:
             if conversation_id in self.active_conversations:
                 del self.active_conversations[conversation_id]
+
+    def end_user_conversations(self, user_id: UUID):
+        with self.lock:
+            for conversation_id, state in list(self.active_conversations.items()):
+                if state["user_id"] == user_id:
+                    del self.active_conversations[conversation_id]
@@ -1,13 +1,19 @@
-from typing import Text
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import List, Optional, Text, Tuple
 from uuid import UUID
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 from starlette.types import Message
 
 from app.assistant import JournalMaker
 
-from .models import Conversation, JournalEntry, User, Message
+from .models import CacheVersion, Conversation, JournalEntry, MoodDailyRollup, SearchDocument, SemanticVector, User, UserMoodStats, Message, utcnow
 from .schemas import UserRegister
+from . import analytics, search, semantic
+from .sentiment import mood_scorer, rollup_mood
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -41,6 +47,72 @@ def create_user(db: Session, user: UserRegister):
     db.refresh(new_user)
     return new_user
 
+def _delete_in_batches(db: Session, model, key, ids_query, batch_size: int):
+    """Deletes the rows `ids_query` selects, committing every `batch_size` rows to keep locks short."""
+    total = 0
+    while True:
+        deleted = db.execute(
+            delete(model)
+            .where(key.in_(ids_query.limit(batch_size)))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+def delete_user(db: Session, user_id: UUID, batch_size: int = 1000):
+    """
+    Removes an account and everything it owns. The largest tables are emptied in
+    short batched transactions before the user row is deleted, so no single
+    statement has to cascade over the whole history.
+    """
+    user_messages = select(Message.msg_id).join(Conversation).where(Conversation.uid == user_id)
+    counts = {
+        "search_documents": _delete_in_batches(db, SearchDocument, SearchDocument.search_id, select(SearchDocument.search_id).where(SearchDocument.uid == user_id), batch_size),
+        "semantic_vectors": _delete_in_batches(db, SemanticVector, SemanticVector.doc_id, select(SemanticVector.doc_id).where(SemanticVector.uid == user_id), batch_size),
+        "messages": _delete_in_batches(db, Message, Message.msg_id, user_messages, batch_size),
+        "journals": _delete_in_batches(db, JournalEntry, JournalEntry.journal_id, select(JournalEntry.journal_id).where(JournalEntry.uid == user_id), batch_size),
+        "conversations": _delete_in_batches(db, Conversation, Conversation.id, select(Conversation.id).where(Conversation.uid == user_id), batch_size),
+    }
+
+    db.execute(delete(MoodDailyRollup).where(MoodDailyRollup.uid == user_id))
+    db.execute(delete(UserMoodStats).where(UserMoodStats.uid == user_id))
+    # Anything written while the batches ran is removed by the cascade
+    counts["users"] = db.execute(delete(User).where(User.id == user_id)).rowcount
+    db.commit()
+    return counts
+
+
+### Cache versions
+
+CONVERSATIONS_SCOPE = "conversations"
+JOURNALS_SCOPE = "journals"
+
+def bump_cache_version(db: Session, user_id: UUID, scope: str):
+    """Invalidates a user's cached responses for `scope`, committed with the caller's write."""
+    bumped = db.execute(
+        update(CacheVersion)
+        .where(CacheVersion.uid == user_id, CacheVersion.scope == scope)
+        .values(version=CacheVersion.version + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if bumped:
+        return
+
+    try:
+        with db.begin_nested():
+            db.add(CacheVersion(uid=user_id, scope=scope, version=1))
+    except IntegrityError:
+        # Another request created the row first
+        bump_cache_version(db, user_id, scope)
+
+def get_cache_version(db: Session, user_id: UUID, scope: str) -> int:
+    version = db.execute(
+        select(CacheVersion.version).where(CacheVersion.uid == user_id, CacheVersion.scope == scope)
+    ).scalar()
+    return version or 0
+
 
 ### Conversation
 
@@ -50,23 +122,41 @@ def create_conversation(db: Session, user_id: UUID):
     )
 
     db.add(conversation)
+    bump_cache_version(db, user_id, CONVERSATIONS_SCOPE)
     db.commit()
     db.refresh(conversation)
     return conversation 
 
-def delete_conversation(db: Session, conversation_id: UUID, user_id: UUID):
-    conversation = db.query(Conversation).filter(
-        Conversation.id == conversation_id and 
+def get_conversation(db: Session, conversation_id: UUID, user_id: UUID):
+    return db.query(Conversation).filter(
+        Conversation.id == conversation_id,
         Conversation.uid == user_id
     ).first()
 
-    if not conversation:
+def delete_conversation(db: Session, conversation_id: UUID, user_id: UUID):
+    # One statement, the database cascades to messages and detaches journals
+    deleted = db.execute(
+        delete(Conversation)
+        .where(Conversation.id == conversation_id, Conversation.uid == user_id)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    if not deleted:
+        db.rollback()
         return False
 
-    db.delete(conversation)
+    search.remove_conversation(db, conversation_id)
+    semantic.remove_conversation(db, conversation_id)
+    bump_cache_version(db, user_id, CONVERSATIONS_SCOPE)
     db.commit()
     return True
 
+def get_conversation_update_time(db: Session, conversation_id: UUID, user_id: UUID) -> Optional[datetime]:
+    return db.execute(
+        select(Conversation.update_time)
+        .where(Conversation.id == conversation_id, Conversation.uid == user_id)
+    ).scalar()
+
 def get_conversations_by_user(db: Session, user_id: UUID, limit: int = 10, offset: int = 0):
     conversations = (
         db.query(Conversation)
@@ -78,6 +168,19 @@ def get_conversations_by_user(db: Session, user_id: UUID, limit: int = 10, offse
     )
     return conversations
 
+def _rollup_conversation(conversation: Conversation, scores: List[Tuple[str, float]]):
+    # Fold newly scored user messages into the conversation's running mood and mean sentiment.
+    # Callers load the conversation FOR UPDATE, concurrent turns would otherwise lose counts
+    mood_counts = dict(conversation.mood_counts or {})
+    for mood, score in scores:
+        mood_counts[mood] = mood_counts.get(mood, 0) + 1
+        conversation.sentiment_sum = (conversation.sentiment_sum or 0.0) + score
+
+    conversation.scored_messages = (conversation.scored_messages or 0) + len(scores)
+    conversation.sentiment_score = conversation.sentiment_sum / conversation.scored_messages
+    conversation.mood_counts = mood_counts
+    conversation.mood = rollup_mood(mood_counts)
+
 def create_message(db: Session, conversation_id: UUID, role: str, content: Text):
     message = Message(
         cid=conversation_id,
@@ -85,17 +188,73 @@ def create_message(db: Session, conversation_id: UUID, role: str, content: Text)
         content=content
     )
 
+    # Scored before the conversation row is locked, so the lock is held only for the update
+    scored = mood_scorer.score(content) if role == "user" else None
+    conversation = db.get(Conversation, conversation_id, with_for_update=True, populate_existing=True)
+    if conversation:
+        # Every message marks the conversation active, the journal scheduler and the
+        # ConvManager cache key off it
+        message.create_time = conversation.update_time = utcnow()
+        # A changed conversation deserves a fresh set of journal attempts
+        conversation.journal_attempts, conversation.journal_retry_after = 0, None
+        if scored:
+            message.mood, message.sentiment_score = scored
+            _rollup_conversation(conversation, [scored])
+
     db.add(message)
+    if conversation:
+        db.flush()
+        search.index_message(db, message, conversation.uid)
+        bump_cache_version(db, conversation.uid, CONVERSATIONS_SCOPE)
     db.commit()
     db.refresh(message)
     return message
 
-def get_conversation_history(db: Session, conversation_id: UUID, user_id: UUID):
+def score_unscored_messages(db: Session, batch_size: int = 500):
+    """Scores user messages written before local scoring existed, in batches."""
+    total = 0
+    while True:
+        messages = (
+            db.query(Message)
+            .filter(Message.role == "user", Message.sentiment_score.is_(None))
+            .limit(batch_size)
+            .all()
+        )
+        if not messages:
+            return total
+
+        scores = mood_scorer.score_batch([msg.content for msg in messages])
+        by_conversation = defaultdict(list)
+        for msg, (mood, score) in zip(messages, scores):
+            msg.mood, msg.sentiment_score = mood, score
+            by_conversation[msg.cid].append((mood, score))
+
+        user_ids = set()
+        locked = (
+            db.query(Conversation)
+            .filter(Conversation.id.in_(by_conversation))
+            .order_by(Conversation.id)
+            .with_for_update()
+            .populate_existing()
+        )
+        for conversation in locked:
+            _rollup_conversation(conversation, by_conversation[conversation.id])
+            user_ids.add(conversation.uid)
+        for user_id in user_ids:
+            bump_cache_version(db, user_id, CONVERSATIONS_SCOPE)
+
+        db.commit()
+        total += len(messages)
+
+def get_conversation_history(db: Session, conversation_id: UUID, user_id: UUID) -> Optional[List[Message]]:
+    # None when the conversation is missing or someone else's, [] when it has no messages yet
+    if get_conversation_update_time(db, conversation_id, user_id) is None:
+        return None
+
     messages = (
         db.query(Message)
-        .join(Conversation)
-        .filter(Conversation.id == conversation_id)
-        .order_by(Conversation.create_time)
+        .filter(Message.cid == conversation_id)
+        .order_by(Message.create_time)
         .all()
     )
 
@@ -103,20 +262,40 @@ def get_conversation_history(db: Session, conversation_id: UUID, user_id: UUID):
 
 ### Journal
 
-def create_journal(db: Session, user_id: UUID, conversation_id: UUID, content: str, mood: str, sentiment_score: float):
+def create_journal(db: Session, user_id: UUID, conversation_id: UUID, content: str, mood: str, sentiment_score: float, source_time: Optional[datetime] = None):
     journal_entry = JournalEntry(
         uid=user_id,
         cid=conversation_id,
         content=content,
         mood=mood,
-        sentiment_score=sentiment_score
+        sentiment_score=sentiment_score,
+        source_time=source_time
     )
 
     db.add(journal_entry)
+    db.flush()
+    analytics.journal_added(db, journal_entry)
+    search.index_journal(db, journal_entry)
+    bump_cache_version(db, user_id, JOURNALS_SCOPE)
     db.commit()
     db.refresh(journal_entry)
     return journal_entry
 
+def save_conversation_journal(db: Session, user_id: UUID, conversation_id: UUID, content: str, mood: str, sentiment_score: float, source_time: Optional[datetime] = None):
+    """Creates the conversation's journal or updates the one it already has."""
+    journal_entry = get_conversation_journal(db, user_id, conversation_id)
+    if journal_entry is None:
+        try:
+            return create_journal(db, user_id, conversation_id, content, mood, sentiment_score, source_time)
+        except IntegrityError:
+            # Another writer created it first, or the conversation was deleted
+            db.rollback()
+            journal_entry = get_conversation_journal(db, user_id, conversation_id)
+            if journal_entry is None:
+                return None
+
+    return update_journal(db, user_id, journal_entry.journal_id, content, mood, sentiment_score, source_time)
+
 def get_multiple_journals(db: Session, user_id: UUID, limit: int = 5, offset: int = 0):
     journal_entries = (
         db.query(JournalEntry)
@@ -131,20 +310,28 @@ def get_multiple_journals(db: Session, user_id: UUID, limit: int = 5, offset: in
 
 def get_single_journal(db: Session, user_id: UUID, journal_id: UUID):
     journal_entry = db.query(JournalEntry).filter(
-        JournalEntry.uid == user_id and
+        JournalEntry.uid == user_id,
         JournalEntry.journal_id == journal_id
     ).first()
 
     return journal_entry
 
-def update_journal(db: Session, user_id: UUID, journal_id: UUID, content: str, mood: str):
+def update_journal(db: Session, user_id: UUID, journal_id: UUID, content: str, mood: str, sentiment_score: Optional[float] = None, source_time: Optional[datetime] = None):
     journal_entry = get_single_journal(db, user_id, journal_id)
 
     if not journal_entry:
         return False
 
+    old_mood, old_sentiment_score = journal_entry.mood, journal_entry.sentiment_score
     journal_entry.content = content
     journal_entry.mood = mood
+    if sentiment_score is not None:
+        journal_entry.sentiment_score = sentiment_score
+    if source_time is not None:
+        journal_entry.source_time = source_time
+    analytics.journal_changed(db, journal_entry, old_mood, old_sentiment_score)
+    search.reindex_journal(db, journal_entry)
+    bump_cache_version(db, user_id, JOURNALS_SCOPE)
 
     db.commit()
     db.refresh(journal_entry)
@@ -152,14 +339,15 @@ def update_journal(db: Session, user_id: UUID, journal_id: UUID, content: str, m
     return journal_entry
 
 def delete_journal(db: Session, user_id: UUID, journal_id: UUID):
-    journal_entry = db.query(JournalEntry).filter(
-        JournalEntry.journal_id == journal_id and 
-        JournalEntry.uid == user_id
-    ).first()
+    journal_entry = get_single_journal(db, user_id, journal_id)
 
     if not journal_entry:
         return False
 
+    analytics.journal_removed(db, journal_entry)
+    search.remove_document(db, journal_entry.journal_id)
+    semantic.remove_document(db, journal_entry.journal_id)
+    bump_cache_version(db, user_id, JOURNALS_SCOPE)
     db.delete(journal_entry)
     db.commit()
     return True
@@ -172,3 +360,76 @@ def get_converations_without_journal(db: Session, user_id: UUID):
         .all()
     )
     return [conv.id for conv in  conversations]
+
+
+def get_conversation_journal(db: Session, user_id: UUID, conversation_id: UUID):
+    return db.query(JournalEntry).filter(
+        JournalEntry.uid == user_id,
+        JournalEntry.cid == conversation_id
+    ).first()
+
+def get_idle_conversations(db: Session, idle_before: datetime, limit: int = 100, max_attempts: int = 5):
+    """
+    Conversations with messages that have been quiet since `idle_before` and whose
+    journal is missing or was generated from an older version of the conversation.
+    Conversations backing off after a failed attempt, or out of attempts, are left out.
+    """
+    has_messages = db.query(Message.msg_id).filter(Message.cid == Conversation.id).exists()
+    conversations = (
+        db.query(Conversation.id, Conversation.uid)
+        .outerjoin(JournalEntry, Conversation.id == JournalEntry.cid)
+        .filter(
+            Conversation.update_time < idle_before,
+            Conversation.journal_attempts < max_attempts,
+            Conversation.journal_retry_after.is_(None) | (Conversation.journal_retry_after <= utcnow()),
+            has_messages,
+            (JournalEntry.journal_id.is_(None))
+            | (func.coalesce(JournalEntry.source_time, JournalEntry.create_time) < Conversation.update_time)
+        )
+        .order_by(Conversation.update_time)
+        .limit(limit)
+        .all()
+    )
+    return [(conv.id, conv.uid) for conv in conversations]
+
+def request_journals(db: Session, conversation_ids: List[UUID]):
+    """Flags conversations for the scheduler, which may be running in another worker."""
+    db.execute(
+        update(Conversation)
+        .where(Conversation.id.in_(conversation_ids))
+        .values(journal_requested=True, update_time=Conversation.update_time)
+    )
+    db.commit()
+
+def claim_requested_journals(db: Session, limit: int = 100) -> List[Tuple[UUID, UUID]]:
+    requested = db.execute(
+        select(Conversation.id, Conversation.uid)
+        .where(Conversation.journal_requested.is_(True))
+        .limit(limit)
+    ).all()
+    if requested:
+        db.execute(
+            update(Conversation)
+            .where(Conversation.id.in_([row.id for row in requested]))
+            .values(journal_requested=False, update_time=Conversation.update_time)
+        )
+        db.commit()
+    return [(row.id, row.uid) for row in requested]
+
+def record_journal_failure(db: Session, conversation_id: UUID, backoff: timedelta) -> Optional[int]:
+    """Counts a failed journal attempt and backs off exponentially; returns the attempts so far."""
+    attempts = db.execute(
+        update(Conversation)
+        .where(Conversation.id == conversation_id)
+        # update_time is kept, the conversation itself did not change
+        .values(journal_attempts=Conversation.journal_attempts + 1, update_time=Conversation.update_time)
+        .returning(Conversation.journal_attempts)
+    ).scalar()
+    if attempts is not None:
+        db.execute(
+            update(Conversation)
+            .where(Conversation.id == conversation_id)
+            .values(journal_retry_after=utcnow() + backoff * 2 ** (attempts - 1), update_time=Conversation.update_time)
+        )
+    db.commit()
+    return attempts
@@ -0,0 +1,128 @@
+from typing import Iterable, Iterator
+from uuid import UUID
+import zlib
+
+import orjson
+from sqlalchemy import select
+
+from .database import SessionLocal
+from .models import Conversation, JournalEntry, Message
+
+EXPORT_BATCH_ROWS = 500
+# Lines are buffered into chunks of about this size before they are sent
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+MESSAGE_COLUMNS = (
+    Message.msg_id, Message.cid, Message.role, Message.content,
+    Message.mood, Message.sentiment_score, Message.create_time,
+)
+CONVERSATION_COLUMNS = (
+    Conversation.id, Conversation.title, Conversation.mood,
+    Conversation.sentiment_score, Conversation.create_time, Conversation.update_time,
+)
+JOURNAL_COLUMNS = (
+    JournalEntry.journal_id, JournalEntry.cid, JournalEntry.content, JournalEntry.mood,
+    JournalEntry.sentiment_score, JournalEntry.create_time, JournalEntry.update_time,
+)
+
+
+def _stream(db, statement):
+    # Plain column rows bypass the identity map, yield_per keeps a server-side cursor
+    # on Postgres and fetches in fixed size batches everywhere else
+    return db.execute(statement.execution_options(yield_per=EXPORT_BATCH_ROWS))
+
+def _conversation_record(row) -> dict:
+    return {
+        "type": "conversation",
+        "id": row.id,
+        "title": row.title,
+        "mood": row.mood,
+        "sentiment_score": row.sentiment_score,
+        "create_time": row.create_time,
+        "update_time": row.update_time,
+    }
+
+def _message_record(row) -> dict:
+    return {
+        "type": "message",
+        "id": row.msg_id,
+        "cid": row.cid,
+        "role": row.role,
+        "content": row.content,
+        "mood": row.mood,
+        "sentiment_score": row.sentiment_score,
+        "create_time": row.create_time,
+    }
+
+def _journal_record(row) -> dict:
+    return {
+        "type": "journal",
+        "id": row.journal_id,
+        "cid": row.cid,
+        "content": row.content,
+        "mood": row.mood,
+        "sentiment_score": row.sentiment_score,
+        "create_time": row.create_time,
+        "update_time": row.update_time,
+    }
+
+def conversation_records(conversation_id: UUID, user_id: UUID) -> Iterator[dict]:
+    with SessionLocal() as db:
+        conversation = db.execute(
+            select(*CONVERSATION_COLUMNS)
+            .where(Conversation.id == conversation_id, Conversation.uid == user_id)
+        ).first()
+        if conversation is None:
+            return
+
+        yield _conversation_record(conversation)
+        messages = (
+            select(*MESSAGE_COLUMNS)
+            .where(Message.cid == conversation_id)
+            .order_by(Message.create_time, Message.msg_id)
+        )
+        for row in _stream(db, messages):
+            yield _message_record(row)
+
+def user_records(user_id: UUID) -> Iterator[dict]:
+    with SessionLocal() as db:
+        # One ordered pass over messages joined to their conversation, a conversation
+        # record is emitted whenever the conversation changes
+        rows = (
+            select(*CONVERSATION_COLUMNS, *MESSAGE_COLUMNS)
+            .outerjoin(Message, Message.cid == Conversation.id)
+            .where(Conversation.uid == user_id)
+            .order_by(Conversation.create_time, Conversation.id, Message.create_time, Message.msg_id)
+        )
+        current = None
+        for row in _stream(db, rows):
+            if row.id != current:
+                current = row.id
+                yield _conversation_record(row)
+            if row.msg_id is not None:
+                yield _message_record(row)
+
+        journals = (
+            select(*JOURNAL_COLUMNS)
+            .where(JournalEntry.uid == user_id)
+            .order_by(JournalEntry.create_time, JournalEntry.journal_id)
+        )
+        for row in _stream(db, journals):
+            yield _journal_record(row)
+
+def ndjson_chunks(records: Iterable[dict], compress: bool = False, chunk_bytes: int = EXPORT_CHUNK_BYTES) -> Iterator[bytes]:
+    """Encodes records as NDJSON, optionally gzipped, in chunks of roughly `chunk_bytes`."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = bytearray()
+
+    for record in records:
+        buffer += orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+        if len(buffer) >= chunk_bytes:
+            chunk = compressor.compress(bytes(buffer)) if compressor else bytes(buffer)
+            buffer.clear()
+            if chunk:
+                yield chunk
+
+    tail = compressor.compress(bytes(buffer)) + compressor.flush() if compressor else bytes(buffer)
+    if tail:
+        yield tail
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
+from typing import Any, Callable, Optional, Tuple
+from uuid import UUID
+import os
+
+from pydantic import TypeAdapter
+from sqlalchemy.orm import Session
+from starlette.requests import Request
+from starlette.responses import Response
+
+from .crud import get_cache_version
+from .metrics import RESPONSE_CACHE_LOOKUPS
+
+# Serialized bodies kept in process, 0 turns the body cache off and leaves only ETags
+HTTP_CACHE_MAX_BYTES = int(os.getenv("HTTP_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Clients may keep the body but must revalidate with If-None-Match on every poll
+CACHE_CONTROL = "private, no-cache"
+
+
+class BodyCache:
+    """LRU of serialized response bodies, bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Tuple, bytes]" = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, key: Tuple) -> Optional[bytes]:
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+            return body
+
+    def put(self, key: Tuple, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+body_cache = BodyCache(HTTP_CACHE_MAX_BYTES)
+
+
+def _etag(user_id: UUID, scope: str, version: int, request: Request) -> str:
+    # The resource is the path and query, the version says whether it changed
+    resource = blake2b(f"{user_id}:{request.url.path}?{request.url.query}".encode(), digest_size=8).hexdigest()
+    return f'W/"{scope}-{version}-{resource}"'
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    # Weak comparison, W/ prefixes are ignored on both sides
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+def cached_json_response(
+    request: Request,
+    db: Session,
+    user_id: UUID,
+    scope: str,
+    adapter: TypeAdapter,
+    load: Callable[[], Any]
+) -> Response:
+    """
+    Serves a read endpoint through the per user version counter of `scope`.
+
+    An unchanged resource costs one version lookup: a 304 when the client sent a
+    matching If-None-Match, otherwise the serialized body from the in process cache.
+    Only on a miss is `load` queried and validated against `adapter`.
+    """
+    version = get_cache_version(db, user_id, scope)
+    etag = _etag(user_id, scope, version, request)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+
+    if _matches(request.headers.get("if-none-match"), etag):
+        RESPONSE_CACHE_LOOKUPS.labels("not_modified").inc()
+        return Response(status_code=304, headers=headers)
+
+    key = (user_id, scope, version, request.url.path, request.url.query)
+    body = body_cache.get(key) if HTTP_CACHE_MAX_BYTES else None
+    if body is None:
+        RESPONSE_CACHE_LOOKUPS.labels("miss").inc()
+        body = adapter.dump_json(adapter.validate_python(load(), from_attributes=True))
+        if HTTP_CACHE_MAX_BYTES:
+            body_cache.put(key, body)
+    else:
+        RESPONSE_CACHE_LOOKUPS.labels("hit").inc()
+
+    return Response(content=body, media_type="application/json", headers=headers)
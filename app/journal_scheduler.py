@@ -0,0 +1,204 @@
+from datetime import timedelta
+from itertools import count
+from time import monotonic
+from typing import Dict, Optional
+from uuid import UUID
+import asyncio, logging, os
+
+from .assistant import JournalMaker, LLMLimiter, llm_limiter
+from .crud import claim_requested_journals, get_conversation, get_conversation_history, get_conversation_journal, get_idle_conversations, record_journal_failure, save_conversation_journal
+from .database import SessionLocal
+from .models import utcnow
+
+logger = logging.getLogger("journal_scheduler")
+
+JOURNAL_SCHEDULER_ENABLED = os.getenv("JOURNAL_SCHEDULER_ENABLED", "true").lower() == "true"
+JOURNAL_IDLE_MINUTES = float(os.getenv("JOURNAL_IDLE_MINUTES", "30"))
+JOURNAL_SCAN_SECONDS = float(os.getenv("JOURNAL_SCAN_SECONDS", "60"))
+# How often requests flagged by other workers are picked up
+JOURNAL_REQUEST_POLL_SECONDS = float(os.getenv("JOURNAL_REQUEST_POLL_SECONDS", "5"))
+JOURNAL_SCAN_BATCH = int(os.getenv("JOURNAL_SCAN_BATCH", "100"))
+# Background summaries only start while fewer generations than this are running and none are queued
+JOURNAL_MAX_LLM_LOAD = int(os.getenv("JOURNAL_MAX_LLM_LOAD", "1"))
+# A conversation whose journal fails is retried after JOURNAL_RETRY_MINUTES, doubling
+# each time, and left alone after JOURNAL_IDLE_MAX_ATTEMPTS until it gets a new message
+JOURNAL_RETRY_MINUTES = float(os.getenv("JOURNAL_RETRY_MINUTES", "5"))
+JOURNAL_IDLE_MAX_ATTEMPTS = int(os.getenv("JOURNAL_IDLE_MAX_ATTEMPTS", "5"))
+
+# Lower runs first; user requests jump ahead of idle scans and are not held back by load
+PRIORITY_REQUESTED = 0
+PRIORITY_IDLE = 1
+
+
+class JournalScheduler:
+    """
+    Pre-generates journals for conversations that went idle.
+
+    A scan loop finds conversations quiet for JOURNAL_IDLE_MINUTES whose journal is
+    missing or older than the conversation and queues them, along with conversations
+    other server workers flagged through /journal/generate_missing. A single worker
+    summarises them one at a time while the LLM is otherwise idle. A conversation that changes
+    while it is being summarised is saved with the version it was built from, so the
+    next scan picks it up again once it is idle.
+    """
+
+    def __init__(self, journal_maker: JournalMaker, limiter: LLMLimiter = llm_limiter):
+        self.journal_maker = journal_maker
+        self.limiter = limiter
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.pending: Dict[UUID, int] = {}
+        self.sequence = count()
+        self.requested: Optional[asyncio.Event] = None
+        self.loop = None
+        self.tasks = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self.tasks)
+
+    def start(self):
+        if not JOURNAL_SCHEDULER_ENABLED or self.running:
+            return
+
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.PriorityQueue()
+        self.requested = asyncio.Event()
+        self.tasks = [
+            asyncio.create_task(self._scan_loop(), name="journal-scan"),
+            asyncio.create_task(self._worker(), name="journal-worker"),
+        ]
+        logger.info("Journal scheduler started idle=%.0fmin scan=%.0fs", JOURNAL_IDLE_MINUTES, JOURNAL_SCAN_SECONDS)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, conversation_id: UUID, user_id: UUID, priority: int = PRIORITY_REQUESTED):
+        """Queues a conversation; safe to call from request threads."""
+        self.loop.call_soon_threadsafe(self._enqueue, conversation_id, user_id, priority)
+
+    def _enqueue(self, conversation_id: UUID, user_id: UUID, priority: int):
+        queued = self.pending.get(conversation_id)
+        if queued is not None and queued <= priority:
+            return
+
+        # A higher priority entry supersedes the queued one, the worker skips stale entries
+        self.pending[conversation_id] = priority
+        self.queue.put_nowait((priority, next(self.sequence), conversation_id, user_id))
+        if priority == PRIORITY_REQUESTED:
+            self.requested.set()
+
+    async def _scan_loop(self):
+        last_idle_scan = None
+        while True:
+            try:
+                requested = await asyncio.to_thread(self._claim_requested)
+                for conversation_id, user_id in requested:
+                    self._enqueue(conversation_id, user_id, PRIORITY_REQUESTED)
+
+                if last_idle_scan is None or monotonic() - last_idle_scan >= JOURNAL_SCAN_SECONDS:
+                    last_idle_scan = monotonic()
+                    idle_before = utcnow() - timedelta(minutes=JOURNAL_IDLE_MINUTES)
+                    conversations = await asyncio.to_thread(self._scan, idle_before)
+                    for conversation_id, user_id in conversations:
+                        self._enqueue(conversation_id, user_id, PRIORITY_IDLE)
+                    if conversations:
+                        logger.info("Queued %d idle conversations for journaling", len(conversations))
+            except Exception as e:
+                logger.error("Idle conversation scan failed: %s", e)
+
+            await asyncio.sleep(min(JOURNAL_REQUEST_POLL_SECONDS, JOURNAL_SCAN_SECONDS))
+
+    def _claim_requested(self):
+        with SessionLocal() as db:
+            return claim_requested_journals(db, JOURNAL_SCAN_BATCH)
+
+    def _scan(self, idle_before):
+        with SessionLocal() as db:
+            return get_idle_conversations(db, idle_before, JOURNAL_SCAN_BATCH, JOURNAL_IDLE_MAX_ATTEMPTS)
+
+    async def _worker(self):
+        while True:
+            entry = await self.queue.get()
+            priority, _, conversation_id, user_id = entry
+            if self.pending.get(conversation_id) != priority:
+                continue
+
+            if priority != PRIORITY_REQUESTED and self._busy():
+                # Idle work goes back in the queue while it waits, so requests queued
+                # in the meantime are taken first
+                self.queue.put_nowait(entry)
+                await self._wait_for_low_load()
+                continue
+            self.pending.pop(conversation_id, None)
+
+            try:
+                if not await self._summarize(conversation_id, user_id):
+                    await asyncio.to_thread(self._record_failure, conversation_id)
+            except Exception as e:
+                logger.error("conversation=%s journal generation failed: %s", conversation_id, e)
+                await asyncio.to_thread(self._record_failure, conversation_id)
+
+    def _busy(self) -> bool:
+        waiting, active = self.limiter.load()
+        return waiting > 0 or active >= JOURNAL_MAX_LLM_LOAD
+
+    async def _wait_for_low_load(self):
+        """Returns once load drops or a user request is queued, whichever comes first."""
+        self.requested.clear()
+        while self._busy() and not self.requested.is_set():
+            try:
+                await asyncio.wait_for(self.requested.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _summarize(self, conversation_id: UUID, user_id: UUID) -> bool:
+        """Returns False when the LLM gave no usable journal."""
+        snapshot = await asyncio.to_thread(self._load, conversation_id, user_id)
+        if snapshot is None:
+            return True
+
+        history, source_time, local_mood = snapshot
+        journal_content, mood, sentiment_score = await self.journal_maker.asummarize(history, with_metadata=local_mood is None)
+        if not journal_content:
+            return False
+        if local_mood is not None:
+            mood, sentiment_score = local_mood
+
+        await asyncio.to_thread(self._save, conversation_id, user_id, journal_content, mood, sentiment_score, source_time)
+        logger.info("conversation=%s journal pre-generated", conversation_id)
+        return True
+
+    def _record_failure(self, conversation_id: UUID):
+        try:
+            with SessionLocal() as db:
+                attempts = record_journal_failure(db, conversation_id, timedelta(minutes=JOURNAL_RETRY_MINUTES))
+        except Exception as e:
+            logger.error("conversation=%s could not record journal failure: %s", conversation_id, e)
+            return
+
+        if attempts is not None and attempts >= JOURNAL_IDLE_MAX_ATTEMPTS:
+            logger.error("conversation=%s journal failed %d times, skipped until it changes", conversation_id, attempts)
+
+    def _load(self, conversation_id: UUID, user_id: UUID):
+        with SessionLocal() as db:
+            conversation = get_conversation(db, conversation_id, user_id)
+            if conversation is None:
+                return None
+
+            journal_entry = get_conversation_journal(db, user_id, conversation_id)
+            if journal_entry and journal_entry.source_time and journal_entry.source_time >= conversation.update_time:
+                return None
+
+            history = get_conversation_history(db, conversation_id, user_id)
+            if not history:
+                return None
+
+            local_mood = (conversation.mood, conversation.sentiment_score) if conversation.scored_messages else None
+            return history, conversation.update_time, local_mood
+
+    def _save(self, conversation_id: UUID, user_id: UUID, content: str, mood: str, sentiment_score: float, source_time):
+        with SessionLocal() as db:
+            save_conversation_journal(db, user_id, conversation_id, content, mood, sentiment_score, source_time)
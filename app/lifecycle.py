@@ -0,0 +1,134 @@
+from typing import Callable, List, Optional, Set
+import asyncio, logging, os, random, tempfile
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows has no flock, every process runs the jobs
+    fcntl = None
+
+logger = logging.getLogger("lifecycle")
+
+BACKGROUND_LOCK_FILE = os.getenv("BACKGROUND_LOCK_FILE", os.path.join(tempfile.gettempdir(), "mindpal-background.lock"))
+
+
+class PendingWrites:
+    """
+    Tracks message writes that run off the request, so shutdown can wait for them.
+
+    Writes are started as their own tasks: a stream cancelled by a disconnect or by
+    the end of the graceful shutdown window still gets its reply saved.
+    """
+
+    def __init__(self):
+        self.tasks: Set[asyncio.Task] = set()
+
+    def submit(self, write: Callable, *args) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(asyncio.to_thread(write, *args))
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error("Pending write failed: %s", task.exception())
+
+    async def drain(self, timeout: float):
+        if not self.tasks:
+            return
+
+        logger.info("Waiting for %d pending message writes", len(self.tasks))
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        if pending:
+            logger.error("%d message writes did not finish within %.0fs", len(pending), timeout)
+
+pending_writes = PendingWrites()
+
+
+class BackgroundLeader:
+    """
+    Elects one worker per host to run background jobs (journal scheduler, semantic
+    indexer) with a non-blocking flock. The lock is released when the holder exits,
+    so a restarted worker can take over.
+    """
+
+    def __init__(self, path: str = BACKGROUND_LOCK_FILE):
+        self.path = path
+        self.file = None
+
+    def acquire(self) -> bool:
+        if fcntl is None:
+            return True
+
+        file = open(self.path, "a+")
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+
+        self.file = file
+        return True
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+background_leader = BackgroundLeader()
+
+
+class HostSlots:
+    """
+    Counting semaphore shared by the worker processes on a host: one flock per slot
+    file in `directory`. A free slot is claimed with a non-blocking lock, so waiters
+    poll; locks held by a worker that dies are released by the kernel.
+    """
+
+    POLL_SECONDS = 0.05
+
+    def __init__(self, count: int, directory: str):
+        self.count = count
+        self.directory = directory
+        self.files: List = []
+        self.held: Set[int] = set()
+
+    def _open(self):
+        if not self.files:
+            os.makedirs(self.directory, exist_ok=True)
+            self.files = [open(os.path.join(self.directory, f"slot-{index}.lock"), "a+") for index in range(self.count)]
+
+    def try_acquire(self) -> Optional[int]:
+        self._open()
+        # Random start so workers do not all contend for slot 0
+        start = random.randrange(self.count)
+        for offset in range(self.count):
+            index = (start + offset) % self.count
+            if index in self.held:
+                continue
+            try:
+                fcntl.flock(self.files[index].fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            self.held.add(index)
+            return index
+        return None
+
+    async def acquire(self) -> int:
+        while True:
+            index = self.try_acquire()
+            if index is not None:
+                return index
+            await asyncio.sleep(self.POLL_SECONDS)
+
+    def release(self, index: int):
+        self.held.discard(index)
+        fcntl.flock(self.files[index].fileno(), fcntl.LOCK_UN)
+
+def host_slots_from_env(count: int) -> Optional[HostSlots]:
+    """Set up in production mode, where the supervisor hands the workers LLM_SLOT_DIR."""
+    directory = os.getenv("LLM_SLOT_DIR")
+    if not directory or fcntl is None:
+        return None
+    return HostSlots(count, directory)
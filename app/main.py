@@ -0,0 +1,57 @@
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+import os
+
+from .database import engine
+from .lifecycle import background_leader, pending_writes
+from .metrics import MetricsMiddleware, instrument_engine, mark_worker_dead
+from .profiling import ProfilingMiddleware, loop_block_monitor
+from .semantic import semantic_indexer
+from .tracing import TracingMiddleware, setup_tracing, trace_engine
+from .routes import auth, chat, export, journal, metrics, search
+
+# Imported by the serving processes only; the production supervisor never builds the app
+PENDING_WRITES_TIMEOUT = float(os.getenv("PENDING_WRITES_TIMEOUT", "15"))
+
+setup_tracing()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop_block_monitor.start()
+    # Only one worker per host runs the background jobs
+    leader = background_leader.acquire()
+    if leader:
+        journal.journal_scheduler.start()
+        semantic_indexer.start()
+    yield
+    # Uvicorn has already waited for in-flight requests and streams, flush what they left behind
+    await pending_writes.drain(PENDING_WRITES_TIMEOUT)
+    if leader:
+        await semantic_indexer.stop()
+        await journal.journal_scheduler.stop()
+        background_leader.release()
+    loop_block_monitor.stop()
+    mark_worker_dead()
+
+app = FastAPI(title="MindPal Chatbot Server", lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(TracingMiddleware)
+app.add_middleware(MetricsMiddleware)
+instrument_engine(engine)
+trace_engine(engine)
+
+app.include_router(auth.router)
+app.include_router(chat.router)
+app.include_router(export.router)
+app.include_router(journal.router)
+app.include_router(metrics.router)
+app.include_router(search.router)
@@ -0,0 +1,194 @@
+from time import perf_counter
+from typing import Optional, Tuple
+import glob, os
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Buckets tuned for LLM work: most chat turns land in the 0.5s - 60s range
+LLM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+REQUEST_LATENCY = Histogram(
+    "mindpal_http_request_duration_seconds",
+    "HTTP request latency, including the full body of streamed responses",
+    ["method", "route", "status"],
+    buckets=LLM_BUCKETS,
+)
+DB_QUERY_LATENCY = Histogram(
+    "mindpal_db_query_duration_seconds",
+    "Time spent executing a single SQL statement",
+    buckets=DB_BUCKETS,
+)
+RETRIEVAL_LATENCY = Histogram(
+    "mindpal_retrieval_duration_seconds",
+    "Time spent retrieving context documents from the vector store",
+    buckets=DB_BUCKETS + (2.5, 5),
+)
+LLM_QUEUE_WAIT = Histogram(
+    "mindpal_llm_queue_wait_seconds",
+    "Time a generation waited for a free LLM slot",
+    ["kind"],
+    buckets=LLM_BUCKETS,
+)
+LLM_QUEUE_DEPTH = Gauge(
+    "mindpal_llm_queue_depth",
+    "Generations currently waiting for a free LLM slot",
+    multiprocess_mode="livesum",
+)
+LLM_ACTIVE = Gauge(
+    "mindpal_llm_active_generations",
+    "Generations currently holding an LLM slot",
+    multiprocess_mode="livesum",
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "mindpal_chat_time_to_first_token_seconds",
+    "Time from receiving a chat message to streaming the first token",
+    buckets=LLM_BUCKETS,
+)
+TOKENS_PER_SECOND = Histogram(
+    "mindpal_chat_tokens_per_second",
+    "Decode rate of a chat response, measured after the first token",
+    buckets=(1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200),
+)
+STREAM_DURATION = Histogram(
+    "mindpal_chat_stream_duration_seconds",
+    "Total duration of a streamed chat response",
+    buckets=LLM_BUCKETS,
+)
+STREAMED_TOKENS = Counter(
+    "mindpal_chat_streamed_tokens_total",
+    "Tokens streamed back to chat clients",
+)
+ACTIVE_STREAMS = Gauge(
+    "mindpal_chat_active_streams",
+    "Chat responses currently being streamed",
+    multiprocess_mode="livesum",
+)
+CONV_CACHE_LOOKUPS = Counter(
+    "mindpal_conv_cache_lookups_total",
+    "ConvManager conversation lookups by result",
+    ["result"],
+)
+RESPONSE_CACHE_LOOKUPS = Counter(
+    "mindpal_response_cache_lookups_total",
+    "Cached read endpoint lookups by result: not_modified, hit or miss",
+    ["result"],
+)
+SEMANTIC_INDEXED = Counter(
+    "mindpal_semantic_indexed_documents_total",
+    "Documents embedded into the semantic search index",
+)
+LOOP_BLOCK_INCIDENTS = Counter(
+    "mindpal_event_loop_block_incidents_total",
+    "Times the event loop was blocked for longer than LOOP_BLOCK_THRESHOLD_MS",
+)
+
+
+def render_metrics():
+    # With several workers each process writes its samples under PROMETHEUS_MULTIPROC_DIR
+    # and whichever worker is scraped aggregates all of them
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+def host_llm_load() -> Optional[Tuple[float, float]]:
+    """
+    Waiting and active generations summed over every worker on the host, read from
+    the multiprocess gauge files. None when the server runs as a single process.
+    """
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not metrics_dir:
+        return None
+
+    totals = {"mindpal_llm_queue_depth": 0.0, "mindpal_llm_active_generations": 0.0}
+    for path in glob.glob(os.path.join(metrics_dir, "gauge_livesum_*.db")):
+        try:
+            metrics = multiprocess.MultiProcessCollector.merge([path], accumulate=False)
+        except FileNotFoundError:
+            # The worker exited and removed its file
+            continue
+        for metric in metrics:
+            if metric.name in totals:
+                totals[metric.name] += sum(sample.value for sample in metric.samples)
+    return totals["mindpal_llm_queue_depth"], totals["mindpal_llm_active_generations"]
+
+def mark_worker_dead():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def instrument_engine(engine: Engine):
+    """Record the duration of every SQL statement executed on `engine`."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_start = perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_LATENCY.observe(perf_counter() - context._query_start)
+
+
+class StreamTimer:
+    """Tracks time-to-first-token, decode rate and duration of one chat stream."""
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.first_token = None
+        self.tokens = 0
+        ACTIVE_STREAMS.inc()
+
+    def token(self):
+        if self.first_token is None:
+            self.first_token = perf_counter()
+            TIME_TO_FIRST_TOKEN.observe(self.first_token - self.start)
+        self.tokens += 1
+
+    def finish(self):
+        end = perf_counter()
+        ACTIVE_STREAMS.dec()
+        STREAM_DURATION.observe(end - self.start)
+        STREAMED_TOKENS.inc(self.tokens)
+
+        if self.first_token is not None and self.tokens > 1 and end > self.first_token:
+            TOKENS_PER_SECOND.observe((self.tokens - 1) / (end - self.first_token))
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware so streamed responses are timed until their last chunk
+    without the buffering overhead of BaseHTTPMiddleware.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Label by route template rather than raw path to keep cardinality bounded
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                str(status_code),
+            ).observe(perf_counter() - start)
@@ -1,10 +1,13 @@
 from datetime import datetime, timezone
-from sqlalchemy import Column, DateTime, Enum, Float, ForeignKey, String, Date, Text
+from sqlalchemy import DDL, JSON, Boolean, Column, DateTime, Enum, Float, ForeignKey, Index, Integer, LargeBinary, String, Date, Text, event, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import UUID
 from .database import Base
 import uuid
 
+def utcnow():
+    return datetime.now(timezone.utc)
+
 class User(Base):
     __tablename__ = "users"
 
@@ -14,8 +17,9 @@ class User(Base):
     dob = Column(Date, nullable=False)
     password = Column(String, nullable=False)
 
-    conversations = relationship("Conversation", back_populates="user", cascade="all, delete-orphan")
-    journal_entries = relationship("JournalEntry", back_populates="user", cascade="all, delete-orphan")
+    # Children are removed by ON DELETE CASCADE, passive_deletes stops the ORM loading them first
+    conversations = relationship("Conversation", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
+    journal_entries = relationship("JournalEntry", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
 
     def __repr__(self) -> str:
         return f"""<User(id={self.id}, name={self.name}, email={self.email}, username={self.username}, dob={self.dob})>"""
@@ -24,14 +28,28 @@ class Conversation(Base):
     __tablename__ = "conversations"
 
     id = Column("conversation_id", UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, unique=True, index=True)
-    uid = Column("user_id", UUID(as_uuid=True), ForeignKey("users.user_id"), nullable=False)
+    uid = Column("user_id", UUID(as_uuid=True), ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
     title = Column(String, default="New chat", nullable=False)
-    create_time = Column(DateTime(timezone=True), default=datetime.now(timezone.utc), nullable=False)
-    update_time = Column(DateTime(timezone=True), default=datetime.now(timezone.utc), nullable=False, onupdate=datetime.now(timezone.utc))
+    create_time = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+    update_time = Column(DateTime(timezone=True), default=utcnow, nullable=False, onupdate=utcnow)
+
+    # Running rollup of the locally scored user messages
+    mood = Column(String(50), nullable=True)
+    sentiment_score = Column(Float, nullable=True)
+    sentiment_sum = Column(Float, default=0.0, nullable=False)
+    scored_messages = Column(Integer, default=0, nullable=False)
+    mood_counts = Column(JSON, default=dict, nullable=False)
+
+    # Failed background journal attempts since the last message, with the time the
+    # next one may run; the idle scan skips conversations that keep failing
+    journal_attempts = Column(Integer, default=0, nullable=False)
+    journal_retry_after = Column(DateTime(timezone=True), nullable=True)
+    # Set by /journal/generate_missing on workers that do not run the scheduler
+    journal_requested = Column(Boolean, default=False, nullable=False)
 
     user = relationship("User", back_populates="conversations")
-    messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
-    journal_entries = relationship("JournalEntry", back_populates="conversation")
+    messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan", passive_deletes=True)
+    journal_entries = relationship("JournalEntry", back_populates="conversation", passive_deletes=True)
 
     def __repr__(self) -> str:
         return f"<ChatSession(cid={self.id}, uid={self.uid}, title={self.title})>"
@@ -40,11 +58,13 @@ class Message(Base):
     __tablename__ = "messages"
 
     msg_id = Column("msg_id", UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, unique=True, index=True)
-    cid = Column("conversation_id", UUID(as_uuid=True), ForeignKey("conversations.conversation_id"), nullable=False)
+    cid = Column("conversation_id", UUID(as_uuid=True), ForeignKey("conversations.conversation_id", ondelete="CASCADE"), nullable=False, index=True)
     role = Column(Enum("user", "assistant", name="role_enum"), nullable=False)
     content = Column(Text, nullable=False)
-    create_time = Column(DateTime(timezone=True), default=datetime.now(timezone.utc), nullable=False)
-    update_time = Column(DateTime(timezone=True), default=datetime.now(timezone.utc), nullable=False, onupdate=datetime.now(timezone.utc))
+    mood = Column(String(50), nullable=True)
+    sentiment_score = Column(Float, nullable=True)
+    create_time = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+    update_time = Column(DateTime(timezone=True), default=utcnow, nullable=False, onupdate=utcnow)
 
     conversation = relationship("Conversation", back_populates="messages")
 
@@ -55,14 +75,121 @@ class JournalEntry(Base):
     __tablename__ = "journal_entries"
 
     journal_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, unique=True, index=True)
-    uid = Column("user_id", UUID(as_uuid=True), ForeignKey("users.user_id"), nullable=False)
-    cid = Column("conversation_id", UUID(as_uuid=True), ForeignKey("conversations.conversation_id"), nullable=True)
-    create_time = Column(DateTime(timezone=True), default=datetime.now(timezone.utc), nullable=False)
-    update_time = Column(DateTime(timezone=True), default=datetime.now(timezone.utc), nullable=False, onupdate=datetime.now(timezone.utc))
+    uid = Column("user_id", UUID(as_uuid=True), ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
+    # Journals outlive the conversation they summarise; one journal per conversation
+    cid = Column("conversation_id", UUID(as_uuid=True), ForeignKey("conversations.conversation_id", ondelete="SET NULL"), nullable=True, unique=True)
+    create_time = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+    update_time = Column(DateTime(timezone=True), default=utcnow, nullable=False, onupdate=utcnow)
     mood = Column(String(50), nullable=True)
     content = Column(Text, nullable=False)
     sentiment_score = Column(Float, nullable=True)
+    # Conversation update_time the journal was generated from, used to detect stale journals
+    source_time = Column(DateTime(timezone=True), nullable=True)
 
     user = relationship("User", back_populates="journal_entries")
     conversation = relationship("Conversation", back_populates="journal_entries")
 
+class MoodDailyRollup(Base):
+    """Per user, per day aggregate of journal moods, kept in step with journal writes."""
+    __tablename__ = "mood_daily_rollups"
+
+    uid = Column("user_id", UUID(as_uuid=True), ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    journal_count = Column(Integer, default=0, nullable=False)
+    sentiment_sum = Column(Float, default=0.0, nullable=False)
+    sentiment_count = Column(Integer, default=0, nullable=False)
+    mood_counts = Column(JSON, default=dict, nullable=False)
+
+class UserMoodStats(Base):
+    __tablename__ = "user_mood_stats"
+
+    uid = Column("user_id", UUID(as_uuid=True), ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    total_journals = Column(Integer, default=0, nullable=False)
+    current_streak = Column(Integer, default=0, nullable=False)
+    longest_streak = Column(Integer, default=0, nullable=False)
+    last_day = Column(Date, nullable=True)
+
+SEARCH_KIND = Enum("message", "journal", name="search_kind_enum")
+
+class CacheVersion(Base):
+    """Per user counters bumped by every write that changes a cached read endpoint."""
+    __tablename__ = "cache_versions"
+
+    uid = Column("user_id", UUID(as_uuid=True), ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    scope = Column(String(32), primary_key=True)
+    version = Column(Integer, default=0, nullable=False)
+
+class SearchDocument(Base):
+    """
+    Denormalised copy of every message and journal a user can search, keyed by owner
+    so search never has to join through conversations.
+
+    The dialect specific index is created alongside the table: a generated tsvector
+    column with a GIN index on Postgres, an external content FTS5 table kept in step
+    by triggers on SQLite.
+    """
+    __tablename__ = "search_documents"
+
+    # Integer key so SQLite's FTS5 table can use it as a stable rowid
+    search_id = Column(Integer, primary_key=True, autoincrement=True)
+    doc_id = Column(UUID(as_uuid=True), nullable=False, unique=True)
+    uid = Column("user_id", UUID(as_uuid=True), ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
+    kind = Column(SEARCH_KIND, nullable=False)
+    cid = Column("conversation_id", UUID(as_uuid=True), nullable=True, index=True)
+    role = Column(String(20), nullable=True)
+    content = Column(Text, nullable=False)
+    create_time = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+    # Set for documents the semantic indexer still has to embed
+    embed_pending = Column(Boolean, default=False, nullable=False)
+    # Failed embedding attempts, the indexer gives up on a document after a few
+    embed_attempts = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        Index(
+            "ix_search_documents_embed_pending", "search_id",
+            postgresql_where=text("embed_pending"), sqlite_where=text("embed_pending = 1"),
+        ),
+    )
+
+SEARCH_DDL = {
+    "postgresql": [
+        "ALTER TABLE search_documents ADD COLUMN search_vector tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('english', content)) STORED",
+        "CREATE INDEX ix_search_documents_search_vector ON search_documents USING GIN (search_vector)",
+    ],
+    "sqlite": [
+        "CREATE VIRTUAL TABLE search_documents_fts USING fts5("
+        "content, content='search_documents', content_rowid='search_id', tokenize='porter unicode61')",
+        "CREATE TRIGGER search_documents_ai AFTER INSERT ON search_documents BEGIN "
+        "INSERT INTO search_documents_fts(rowid, content) VALUES (new.search_id, new.content); END",
+        "CREATE TRIGGER search_documents_ad AFTER DELETE ON search_documents BEGIN "
+        "INSERT INTO search_documents_fts(search_documents_fts, rowid, content) VALUES ('delete', old.search_id, old.content); END",
+        "CREATE TRIGGER search_documents_au AFTER UPDATE OF content ON search_documents BEGIN "
+        "INSERT INTO search_documents_fts(search_documents_fts, rowid, content) VALUES ('delete', old.search_id, old.content); "
+        "INSERT INTO search_documents_fts(rowid, content) VALUES (new.search_id, new.content); END",
+    ],
+}
+
+for dialect, statements in SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(SearchDocument.__table__, "after_create", DDL(statement).execute_if(dialect=dialect))
+event.listen(
+    SearchDocument.__table__, "before_drop",
+    DDL("DROP TABLE IF EXISTS search_documents_fts").execute_if(dialect="sqlite")
+)
+
+class SemanticVector(Base):
+    """
+    int8 quantized embedding of one search document. The key leads with user_id so a
+    user's vectors are a single index range and never mixed with anyone else's.
+    """
+    __tablename__ = "semantic_vectors"
+
+    uid = Column("user_id", UUID(as_uuid=True), ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    doc_id = Column(UUID(as_uuid=True), primary_key=True)
+    kind = Column(SEARCH_KIND, nullable=False)
+    cid = Column("conversation_id", UUID(as_uuid=True), nullable=True)
+    create_time = Column(DateTime(timezone=True), nullable=False)
+    model = Column(String, nullable=False)
+    scale = Column(Float, nullable=False)
+    vector = Column(LargeBinary, nullable=False)
@@ -0,0 +1,140 @@
+from datetime import datetime, timezone
+from pathlib import Path
+from time import monotonic
+import asyncio, hmac, logging, os, random, re, sys, threading, traceback
+
+from pyinstrument import Profiler
+from pyinstrument.renderers import SpeedscopeRenderer
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .metrics import LOOP_BLOCK_INCIDENTS
+
+logger = logging.getLogger("profiling")
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "x-profile").lower().encode()
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", "./profiles"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_CONCURRENT = int(os.getenv("PROFILE_MAX_CONCURRENT", "1"))
+LOOP_BLOCK_THRESHOLD_MS = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "0"))
+
+
+def _slug(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", value).strip("_") or "root"
+
+def _write(path: Path, content: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles a sampled fraction of requests, or requests carrying the admin header,
+    with pyinstrument and writes one speedscope file per request under PROFILE_DIR/<route>/.
+
+    Only coroutines on the event loop are sampled: sync (def) handlers executing in the
+    threadpool show up as time awaited in the request.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.active = 0
+
+    def _should_profile(self, scope: Scope) -> bool:
+        if self.active >= PROFILE_MAX_CONCURRENT:
+            return False
+
+        if PROFILE_ADMIN_TOKEN:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER:
+                    return hmac.compare_digest(value, PROFILE_ADMIN_TOKEN.encode())
+
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        self.active += 1
+        profiler = Profiler(interval=PROFILE_INTERVAL_MS / 1000, async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.stop()
+            self.active -= 1
+
+            route = getattr(scope.get("route"), "path", scope["path"])
+            timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+            path = PROFILE_DIR / f"{scope['method']}_{_slug(route)}" / f"{timestamp}.speedscope.json"
+            try:
+                # Rendering is CPU bound, keep it off the event loop
+                content = await asyncio.to_thread(profiler.output, SpeedscopeRenderer())
+                await asyncio.to_thread(_write, path, content)
+                logger.info("route=%s profile=%s", route, path)
+            except Exception as e:
+                logger.error("route=%s failed to write profile: %s", route, e)
+
+
+class LoopBlockMonitor:
+    """
+    Watchdog thread that notices when the event loop stops processing callbacks for
+    longer than the threshold and records the stack of the code holding the loop.
+    """
+
+    def __init__(self, threshold_ms: float = LOOP_BLOCK_THRESHOLD_MS, log_path: Path = PROFILE_DIR / "loop_blocks.log"):
+        self.threshold = threshold_ms / 1000
+        self.interval = max(self.threshold / 4, 0.01)
+        self.log_path = log_path
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = monotonic()
+        self.reported_beat = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.threshold <= 0:
+            return
+
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self._beat()
+        self.thread = threading.Thread(target=self._watch, name="loop-block-monitor", daemon=True)
+        self.thread.start()
+        logger.info("Event loop block monitor started with threshold=%.0fms", self.threshold * 1000)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(timeout=1)
+
+    def _beat(self):
+        self.last_beat = monotonic()
+        if not self.stopped.is_set():
+            self.loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            beat = self.last_beat
+            blocked = monotonic() - beat
+            if blocked < self.threshold + self.interval or self.reported_beat == beat:
+                continue
+
+            # Report each incident once, with the stack captured while it is still blocking
+            self.reported_beat = beat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<unavailable>\n"
+            LOOP_BLOCK_INCIDENTS.inc()
+            logger.warning("Event loop blocked for at least %.0fms", blocked * 1000)
+
+            try:
+                self.log_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.log_path, "a") as log:
+                    log.write(f"--- {datetime.now(timezone.utc).isoformat()} blocked>={blocked * 1000:.0f}ms\n{stack}")
+            except OSError as e:
+                logger.error("Failed to record event loop block: %s", e)
+
+loop_block_monitor = LoopBlockMonitor()
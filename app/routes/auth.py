@@ -8,6 +8,7 @@ from ..database import get_db
 from ..oauth2 import create_token, get_current_user, verify_token
 from ..models import User
 from .. import crud
+from .chat import conv_manager
 
 router = APIRouter(
     prefix="/auth",
@@ -47,6 +48,13 @@ async def login(user_creds: UserLogin, db: db_dependency):
 async def get_user(user: user_dependency):
     return {"name": user.name, "email": user.email}
 
+@router.delete("/user", response_description="Delete account and all of its data", status_code=status.HTTP_200_OK)
+def delete_account(user: user_dependency, db: db_dependency):
+    user_id = user.id
+    counts = crud.delete_user(db, user_id)
+    conv_manager.end_user_conversations(user_id)
+    return {"message": "Account deleted successfully", "deleted": counts}
+
 @router.get("/refresh", response_description="Refresh token", status_code=status.HTTP_200_OK, response_model=TokenData)
 async def refresh_token(db: db_dependency, token: str = Depends(oauth2_scheme)):
     user_id = verify_token(token, "refresh")
@@ -1,19 +1,28 @@
-from typing import Annotated, List
+from typing import Annotated, Dict, List, Optional
 from uuid import UUID
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Request, WebSocket, WebSocketDisconnect
+from jose import jwt
 from sqlalchemy.orm import Session
 from starlette import status
+from pydantic import TypeAdapter
+from starlette.concurrency import run_in_threadpool
 
 from starlette.responses import StreamingResponse
+import asyncio, json, logging, time
 
-from ..assistant import Assistant
+from ..assistant import Assistant, llm_limiter
 from ..conv_manager import ConvManager
+from ..metrics import StreamTimer
 
-from ..schemas import ConversationData, MessageData
-from ..crud import delete_conversation, get_conversation_history, get_conversations_by_user 
-from ..database import get_db
+from ..http_cache import cached_json_response
+from ..schemas import ConversationData, ConversationMood, CoversationHistory, MessageData
+from ..crud import CONVERSATIONS_SCOPE, delete_conversation, get_conversation, get_conversation_history, get_conversation_update_time, get_conversations_by_user, get_user_by_id
+from ..database import SessionLocal, get_db
+from ..lifecycle import pending_writes
 from ..models import User
-from ..oauth2 import get_current_user
+from ..oauth2 import get_current_user, verify_token
+
+logger = logging.getLogger("chat_route")
 
 router = APIRouter(
     prefix="/chat",
@@ -26,6 +35,23 @@ db_dependency = Annotated[Session, Depends(get_db)]
 conv_manager = ConvManager()
 assistant = Assistant()
 
+async def stream_reply(state: Dict):
+    """Runs the assistant for state["question"] and yields the response as it is generated."""
+    state["generation"] = ""
+    timer = StreamTimer()
+    try:
+        async with llm_limiter.slot("chat"):
+            async for response, _ in assistant.workflow.astream(
+                state,
+                stream_mode="messages"
+            ):
+                if response.content:
+                    timer.token()
+                    state["generation"] += response.content
+                    yield response.content
+    finally:
+        timer.finish()
+
 @router.get("/protected")
 async def protected(_: user_dependency):
     return {"message": "Hey I'am protected."}
@@ -39,17 +65,24 @@ async def start_new_conversation(user: user_dependency, db: db_dependency):
 
 @router.delete("/delete/{conversation_id}", response_description="Delete chat session")
 async def remove_conversation(conversation_id: UUID, user: user_dependency, db: db_dependency):
-    success = delete_conversation(db, conversation_id, user)
+    success = delete_conversation(db, conversation_id, user.id)
     if not success:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Chat session not found")
+    conv_manager.end_coversation(conversation_id)
     return {"message": "Chat session deleted successfully"}
 
+conversation_list_adapter = TypeAdapter(List[ConversationData])
+conversation_history_adapter = TypeAdapter(CoversationHistory)
+
 @router.get("/conversations", response_description="Get conversations", response_model=List[ConversationData])
-async def get_conversations(limit: int, offset: int, user: user_dependency, db: db_dependency):
-    return get_conversations_by_user(db, UUID(str(user.id)), limit, offset)
+def get_conversations(limit: int, offset: int, request: Request, user: user_dependency, db: db_dependency):
+    return cached_json_response(
+        request, db, user.id, CONVERSATIONS_SCOPE, conversation_list_adapter,
+        lambda: get_conversations_by_user(db, UUID(str(user.id)), limit, offset)
+    )
 
 @router.post("/{conversation_id}/message", response_description="Stream chat response")
-async def conversation(msg: MessageData, conversation_id: UUID, background_tasks: BackgroundTasks, user: user_dependency, db: db_dependency):
+async def conversation(msg: MessageData, conversation_id: UUID, user: user_dependency, db: db_dependency):
     """
     Implement Server-Side Events for streaming response 
     """
@@ -59,54 +92,233 @@ async def conversation(msg: MessageData, conversation_id: UUID, background_tasks
 
     state["question"] = msg.content
     conv_manager.add_messages(conversation_id, role="user", content=msg.content, db=db)
-    print(state)
+    logger.debug("conversation=%s history_len=%d question_len=%d", conversation_id, len(state["conversation_history"]), len(msg.content))
 
     # state = assistant.workflow.invoke(state)
 
-    def save_assistant_response(conv_id: UUID, content: str, db: Session):
-        conv_manager.add_messages(conversation_id, role="assistant", content=state['generation'], db=db)
-        print(f"Saved assistant response with length: {len(content)}")
+    def save_assistant_response(conv_id: UUID, content: str):
+        with SessionLocal() as db:
+            conv_manager.add_messages(conv_id, role="assistant", content=content, db=db)
+        logger.debug("conversation=%s saved assistant response length=%d", conv_id, len(content))
 
     async def stream_generator():
         full_response = ""
         try: 
-            async for response, _ in assistant.workflow.astream(
-                state,
-                stream_mode="messages"
-            ): 
-                if response.content:
-                    print(response.content, end="|", flush=True)
-                    yield f"{response.content}"
-                    full_response += response.content
-                    state['generation'] += response.content
+            async for chunk in stream_reply(state):
+                yield chunk
+                full_response += chunk
         finally:
+            # Tracked outside the request so a stream cut short by shutdown is still saved
             if full_response:
-                background_tasks.add_task(
-                    save_assistant_response,
-                    conversation_id,
-                    full_response,
-                    db
-                )
+                pending_writes.submit(save_assistant_response, conversation_id, full_response)
 
     # return {"message": state["generation"]}
     return StreamingResponse(stream_generator(), media_type="text/event-stream")
 
 
-@router.get("/{conversation_id}", response_description="Get conversation history")
-async def conversation_history(conversation_id: UUID, user: user_dependency, db: db_dependency):
-    messages = get_conversation_history(db, conversation_id, UUID(str(user.id)))
+class ChatConnection:
+    """
+    State bound to one authenticated chat WebSocket.
+
+    Client frames are JSON objects with a `type` and a client chosen `id`:
+        {"type": "start", "id": "s1"}
+        {"type": "message", "id": "m1", "cid": "<conversation id>", "content": "..."}
+        {"type": "cancel", "id": "m1"}
+        {"type": "ping"}
+
+    Server frames are compact JSON keyed by `t`: started, tok (with `d`), end,
+    cancelled, err (with `e`) and pong, each echoing the `id` they belong to.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: UUID, expires_at: float):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.expires_at = expires_at
+        self.conversations: Dict[UUID, Dict] = {}
+        self.turns: Dict[str, asyncio.Task] = {}
+        self.busy = set()
+        self.send_lock = asyncio.Lock()
+        self.closed = False
+
+    async def send(self, **frame):
+        if self.closed:
+            return
+        try:
+            async with self.send_lock:
+                await self.websocket.send_text(json.dumps(frame, separators=(",", ":")))
+        except (WebSocketDisconnect, RuntimeError):
+            self.closed = True
+
+    @property
+    def expired(self) -> bool:
+        return time.time() > self.expires_at
+
+    async def close_expired(self, frame_id: Optional[str] = None):
+        await self.send(t="err", id=frame_id, e="Token has expired")
+        if not self.closed:
+            self.closed = True
+            await self.websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+
+    async def run(self):
+        try:
+            while True:
+                frame = None
+                text = await self.websocket.receive_text()
+                if self.expired:
+                    await self.close_expired()
+                    break
+
+                try:
+                    frame = json.loads(text)
+                    await self.dispatch(frame)
+                except (ValueError, KeyError, TypeError) as e:
+                    await self.send(t="err", id=frame.get("id") if isinstance(frame, dict) else None, e=f"Invalid frame: {e}")
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.closed = True
+            # Cancelled turns still persist whatever was generated before the disconnect
+            for task in list(self.turns.values()):
+                task.cancel()
+            await asyncio.gather(*self.turns.values(), return_exceptions=True)
+
+    async def dispatch(self, frame: Dict):
+        kind = frame["type"]
+        frame_id = frame.get("id")
+
+        if kind == "ping":
+            await self.send(t="pong", id=frame_id)
+        elif kind == "start":
+            conversation_id = await run_in_threadpool(self._start)
+            await self.send(t="started", id=frame_id, cid=str(conversation_id))
+        elif kind == "cancel":
+            task = self.turns.get(frame_id)
+            if task:
+                task.cancel()
+        elif kind == "message":
+            if not isinstance(frame.get("cid"), str):
+                await self.send(t="err", id=frame_id, e="Conversation id must be a string")
+                return
+            conversation_id = UUID(frame["cid"])
+            content = frame["content"]
+            if not frame_id or frame_id in self.turns:
+                await self.send(t="err", id=frame_id, e="Message id is missing or already in use")
+                return
+            if not isinstance(content, str) or not content.strip():
+                await self.send(t="err", id=frame_id, e="Message content is empty")
+                return
+            if conversation_id in self.busy:
+                await self.send(t="err", id=frame_id, e="Conversation is already generating a response")
+                return
 
-    msgs = [
-        MessageData(
-            msg_id=msg.msg_id,
-            role=msg.role,
-            content=msg.content,
-            create_time=msg.create_time,
-            update_time=msg.update_time
-        ) for msg in messages
-    ]
+            state = self.conversations.get(conversation_id)
+            if state is None:
+                state = await run_in_threadpool(self._load_conversation, conversation_id)
+                if state is None:
+                    await self.send(t="err", id=frame_id, e="Conversation not found")
+                    return
+                self.conversations[conversation_id] = state
+
+            self.busy.add(conversation_id)
+            task = asyncio.create_task(self._turn(frame_id, conversation_id, state, content))
+            # Done callback also covers turns cancelled before they started running
+            task.add_done_callback(lambda _: (self.turns.pop(frame_id, None), self.busy.discard(conversation_id)))
+            self.turns[frame_id] = task
+        else:
+            await self.send(t="err", id=frame_id, e=f"Unknown frame type: {kind}")
+
+    def _start(self) -> UUID:
+        with SessionLocal() as db:
+            return conv_manager.start_conversation(self.user_id, db)
+
+    def _load_conversation(self, conversation_id: UUID) -> Optional[Dict]:
+        with SessionLocal() as db:
+            if not get_conversation(db, conversation_id, self.user_id):
+                return None
+            return conv_manager.get_conversation(self.user_id, conversation_id, db)
+
+    def _persist(self, conversation_id: UUID, role: str, content: str):
+        with SessionLocal() as db:
+            conv_manager.add_messages(conversation_id, role=role, content=content, db=db)
+
+    async def _turn(self, frame_id: str, conversation_id: UUID, state: Dict, content: str):
+        full_response = ""
+        try:
+            # Turns outlive the frame that started them, the token may have run out since
+            if self.expired:
+                await self.close_expired(frame_id)
+                return
+
+            # The connection holds the state; put it back if the shared cache evicted it
+            conv_manager.keep_alive(conversation_id, state)
+            state["question"] = content
+            await run_in_threadpool(self._persist, conversation_id, "user", content)
+
+            async for chunk in stream_reply(state):
+                full_response += chunk
+                await self.send(t="tok", id=frame_id, d=chunk)
+            await self.send(t="end", id=frame_id)
+        except asyncio.CancelledError:
+            await self.send(t="cancelled", id=frame_id)
+        except Exception as e:
+            logger.error("conversation=%s websocket turn failed: %s", conversation_id, e)
+            await self.send(t="err", id=frame_id, e="Failed to generate response")
+        finally:
+            if full_response:
+                await asyncio.shield(pending_writes.submit(self._persist, conversation_id, "assistant", full_response))
+
+
+@router.websocket("/ws")
+async def chat_socket(websocket: WebSocket, token: Optional[str] = None):
+    """
+    Authenticates once per connection (query `token` or Authorization header), then
+    multiplexes chat turns for any of the user's conversations over the socket.
+    """
+    authorization = websocket.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+
+    try:
+        user_id = verify_token(token or "", "access")
+        expires_at = float(jwt.get_unverified_claims(token)["exp"])
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    def load_user():
+        with SessionLocal() as db:
+            return get_user_by_id(db, user_id) is not None
+
+    if not await run_in_threadpool(load_user):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    await ChatConnection(websocket, user_id, expires_at).run()
+
+
+@router.get("/{conversation_id}/mood", response_description="Live conversation mood", response_model=ConversationMood)
+async def conversation_mood(conversation_id: UUID, user: user_dependency, db: db_dependency):
+    conversation = get_conversation(db, conversation_id, UUID(str(user.id)))
+    if not conversation:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+
+    return {
+        "cid": conversation.id,
+        "mood": conversation.mood,
+        "sentiment_score": conversation.sentiment_score,
+        "scored_messages": conversation.scored_messages,
+    }
+
+@router.get("/{conversation_id}", response_description="Get conversation history", response_model=CoversationHistory)
+def conversation_history(conversation_id: UUID, request: Request, user: user_dependency, db: db_dependency):
+    if get_conversation_update_time(db, conversation_id, UUID(str(user.id))) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
 
-    return {"cid": conversation_id, "items": msgs}
+    return cached_json_response(
+        request, db, user.id, CONVERSATIONS_SCOPE, conversation_history_adapter,
+        lambda: {"cid": conversation_id, "items": get_conversation_history(db, conversation_id, UUID(str(user.id)))}
+    )
 
 @router.post("/message/{conversation_id}")
 async def edit_conversation(coversation_id: str ):
@@ -0,0 +1,39 @@
+from typing import Annotated
+from uuid import UUID
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from starlette import status
+from starlette.responses import StreamingResponse
+
+from ..crud import get_conversation
+from ..database import get_db
+from ..export import conversation_records, ndjson_chunks, user_records
+from ..models import User, utcnow
+from ..oauth2 import get_current_user
+
+router = APIRouter(
+    prefix="/export",
+    tags=["Export"]
+)
+
+user_dependency = Annotated[User, Depends(get_current_user)]
+db_dependency = Annotated[Session, Depends(get_db)]
+
+def ndjson_response(records, filename: str, gzip: bool):
+    # The generator is synchronous so Starlette pulls every chunk, and the database
+    # reads behind it, from the threadpool rather than the event loop
+    headers = {"Content-Disposition": f'attachment; filename="{filename}.ndjson{".gz" if gzip else ""}"'}
+    media_type = "application/gzip" if gzip else "application/x-ndjson"
+    return StreamingResponse(ndjson_chunks(records, compress=gzip), media_type=media_type, headers=headers)
+
+@router.get("/", response_description="Stream all conversations, messages and journals as NDJSON")
+def export_all(user: user_dependency, gzip: bool = False):
+    filename = f"mindpal-export-{utcnow():%Y%m%d}"
+    return ndjson_response(user_records(user.id), filename, gzip)
+
+@router.get("/conversations/{conversation_id}", response_description="Stream one conversation as NDJSON")
+def export_conversation(conversation_id: UUID, user: user_dependency, db: db_dependency, gzip: bool = False):
+    if get_conversation(db, conversation_id, user.id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+
+    return ndjson_response(conversation_records(conversation_id, user.id), f"conversation-{conversation_id}", gzip)
@@ -1,23 +1,23 @@
-from typing import Annotated, List
+from datetime import date, timedelta
+from typing import Annotated, List, Literal, Optional
 from uuid import UUID
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
+from pydantic import TypeAdapter
 from sqlalchemy.orm import Session
 from starlette.status import HTTP_404_NOT_FOUND
 import asyncio, logging
 
+from app.analytics import get_trends
 from app.assistant import JournalMaker
-from app.crud import create_journal, get_converations_without_journal, get_conversation_history, get_multiple_journals, get_single_journal, update_journal, delete_journal
+from app.crud import JOURNALS_SCOPE, get_conversation, get_converations_without_journal, get_conversation_history, get_multiple_journals, get_single_journal, request_journals, save_conversation_journal, update_journal, delete_journal
 from app.database import get_db
-from app.models import User
+from app.http_cache import cached_json_response
+from app.journal_scheduler import JOURNAL_SCHEDULER_ENABLED, JournalScheduler
+from app.models import User, utcnow
 from app.oauth2 import get_current_user
-from app.schemas import JournalEditData, JournalEntryData
+from app.schemas import JournalEditData, JournalEntryData, MoodTrends
 
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s %(levelname)s %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
 logger = logging.getLogger("journal_route")
 
 router = APIRouter(
@@ -29,23 +29,41 @@ user_dependency = Annotated[User, Depends(get_current_user)]
 db_dependency = Annotated[Session, Depends(get_db)]
 
 journal_maker = JournalMaker()
+journal_scheduler = JournalScheduler(journal_maker)
 
 
 @router.get("/generate_missing")
 def generate_missing_journals(user: user_dependency, db: db_dependency):
     conversation_ids = get_converations_without_journal(db, user.id)
-    logger.info(f"Fetched missing conversation: {conversation_ids}")
+    logger.info("user=%s missing_journals=%d", user.id, len(conversation_ids))
 
     if not conversation_ids:
         return {"message": "All journals are up to date."}
 
+    # Most journals are pre-generated once conversations go idle; hand the rest to the
+    # scheduler. It runs in one worker only, the others pass the request on through the database
+    if JOURNAL_SCHEDULER_ENABLED:
+        if journal_scheduler.running:
+            for conversation_id in conversation_ids:
+                journal_scheduler.submit(conversation_id, user.id)
+        else:
+            request_journals(db, conversation_ids)
+        return {"message": "Journals are beind generated.", "queued": len(conversation_ids)}
+
     for conversation_id in conversation_ids:
         """Processes a single conversation and creates a journal entry."""
         chat_history = get_conversation_history(db, conversation_id, user.id)
-        journal_content, mood, sentiment_score = journal_maker.summarize(chat_history)
+
+        # Mood and sentiment come from the locally scored messages when available,
+        # so the LLM only has to write the narrative
+        conversation = get_conversation(db, conversation_id, user.id)
+        scored_locally = conversation is not None and conversation.scored_messages > 0
+        journal_content, mood, sentiment_score = journal_maker.summarize(chat_history, with_metadata=not scored_locally)
+        if scored_locally:
+            mood, sentiment_score = conversation.mood, conversation.sentiment_score
 
         if journal_content:
-            create_journal(db, user.id, conversation_id, journal_content, mood, sentiment_score)
+            save_conversation_journal(db, user.id, conversation_id, journal_content, mood, sentiment_score, conversation.update_time if conversation else None)
             logger.info(f"Journal created for conversation {conversation_id}")
         else:
             logger.error(f"Failed to generate journal for conversation {conversation_id}")
@@ -53,9 +71,29 @@ def generate_missing_journals(user: user_dependency, db: db_dependency):
 
     return {"message": "Journals are beind generated."}
 
+journal_list_adapter = TypeAdapter(List[JournalEntryData])
+
 @router.get("/", response_model=List[JournalEntryData])
-def list_journals(limit: int, offset: int, user: user_dependency, db: db_dependency):
-    return get_multiple_journals(db, user.id, limit, offset)
+def list_journals(limit: int, offset: int, request: Request, user: user_dependency, db: db_dependency):
+    return cached_json_response(
+        request, db, user.id, JOURNALS_SCOPE, journal_list_adapter,
+        lambda: get_multiple_journals(db, user.id, limit, offset)
+    )
+
+@router.get("/trends", response_model=MoodTrends)
+def mood_trends(
+    user: user_dependency,
+    db: db_dependency,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    granularity: Literal["day", "week"] = "day"
+):
+    end = end or utcnow().date()
+    start = start or end - timedelta(days=30)
+    if start > end or (end - start).days > 731:
+        raise HTTPException(status_code=400, detail="Range must be ordered and at most two years long")
+
+    return get_trends(db, user.id, start, end, granularity)
 
 @router.get("/{journal_id}", response_model=JournalEntryData)
 def get_journal_entry(journal_id: UUID, user: user_dependency, db: db_dependency):
@@ -80,7 +118,7 @@ def edit_journal_entry(journal_id: UUID, journal_edited_data: JournalEditData, u
 def delete_journal_entry(journal_id: UUID, user: user_dependency, db: db_dependency):
     success = delete_journal(db, user.id, journal_id)
     if not success:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Journal entry not found")
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"Journal entry not found")
     return {"message": "Journal entry deleted successfully"}
 
 
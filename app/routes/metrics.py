@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+from starlette.responses import Response
+
+from ..metrics import render_metrics
+
+router = APIRouter(
+    tags=["Metrics"]
+)
+
+@router.get("/metrics", include_in_schema=False)
+def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
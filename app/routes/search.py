@@ -0,0 +1,60 @@
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Annotated, Literal, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from starlette import status
+from starlette.concurrency import run_in_threadpool
+
+from ..database import get_db
+from ..models import User
+from ..oauth2 import get_current_user
+from ..schemas import SearchResults, SemanticResults
+from ..search import InvalidCursor, SearchUnavailable, search
+from ..semantic import semantic_embeddings, semantic_search
+
+router = APIRouter(
+    prefix="/search",
+    tags=["Search"]
+)
+
+user_dependency = Annotated[User, Depends(get_current_user)]
+db_dependency = Annotated[Session, Depends(get_db)]
+
+@router.get("/", response_model=SearchResults)
+def search_history(
+    user: user_dependency,
+    db: db_dependency,
+    q: Annotated[str, Query(min_length=1, max_length=256)],
+    kind: Optional[Literal["message", "journal"]] = None,
+    limit: Annotated[int, Query(ge=1, le=50)] = 20,
+    cursor: Optional[str] = None
+):
+    try:
+        items, next_cursor = search(db, user.id, q, kind, cursor, limit)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except SearchUnavailable as e:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
+
+    return {"items": items, "next_cursor": next_cursor}
+
+@router.get("/semantic", response_model=SemanticResults)
+async def semantic_search_history(
+    user: user_dependency,
+    db: db_dependency,
+    q: Annotated[str, Query(min_length=1, max_length=1000)],
+    top_k: Annotated[int, Query(ge=1, le=50)] = 10,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    kind: Optional[Literal["message", "journal"]] = None
+):
+    if start and end and start > end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start must not be after end")
+
+    # Dates are inclusive days in UTC
+    start_time = datetime.combine(start, time.min, timezone.utc) if start else None
+    end_time = datetime.combine(end + timedelta(days=1), time.min, timezone.utc) if end else None
+
+    query_vector = await semantic_embeddings.aembed_query(q)
+    items = await run_in_threadpool(semantic_search, db, user.id, query_vector, top_k, start_time, end_time, kind)
+    return {"items": items}
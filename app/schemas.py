@@ -1,6 +1,6 @@
-from typing import List, Literal, Optional, Text
+from typing import Dict, List, Literal, Optional, Text
 from uuid import UUID
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field, field_validator
 from datetime import date, datetime
 
 class UserRegister(BaseModel):
@@ -23,12 +23,22 @@ class ConversationData(BaseModel):
     title: str
     create_time: datetime
     update_time: datetime
+    mood: Optional[str] = None
+    sentiment_score: Optional[float] = None
+
+class ConversationMood(BaseModel):
+    cid: UUID
+    mood: Optional[str] = None
+    sentiment_score: Optional[float] = None
+    scored_messages: int = 0
 
 class MessageData(BaseModel):
     msg_id: Optional[UUID] = None
     cid: Optional[UUID] = None
     role: Literal["user", "assistant"]
     content: Text
+    mood: Optional[str] = None
+    sentiment_score: Optional[float] = None
     create_time: Optional[datetime] = None
     update_time: Optional[datetime] = None
 
@@ -49,3 +59,73 @@ class JournalEditData(BaseModel):
     content: Optional[str] = None
     mood: Optional[str] = None
 
+
+class MoodTrendBucket(BaseModel):
+    start: date
+    journal_count: int
+    average_sentiment: Optional[float] = None
+    mood_counts: Dict[str, int]
+
+class MoodTrends(BaseModel):
+    start: date
+    end: date
+    granularity: Literal["day", "week"]
+    buckets: List[MoodTrendBucket]
+    mood_distribution: Dict[str, int]
+    current_streak: int
+    longest_streak: int
+    total_journals: int
+
+class SearchHit(BaseModel):
+    id: UUID
+    kind: Literal["message", "journal"]
+    cid: Optional[UUID] = None
+    role: Optional[str] = None
+    create_time: datetime
+    score: float
+    # HTML escaped text with the matched terms wrapped in <mark>
+    snippet: str
+
+class SearchResults(BaseModel):
+    items: List[SearchHit]
+    next_cursor: Optional[str] = None
+
+class SemanticHit(BaseModel):
+    id: UUID
+    kind: Literal["message", "journal"]
+    cid: Optional[UUID] = None
+    role: Optional[str] = None
+    create_time: datetime
+    score: float
+    content: str
+
+class SemanticResults(BaseModel):
+    items: List[SemanticHit]
+
+class JournalNarrative(BaseModel):
+    journal_content: str = Field(min_length=1)
+
+    @field_validator("journal_content")
+    @classmethod
+    def strip_content(cls, value: str) -> str:
+        value = value.strip()
+        if not value:
+            raise ValueError("must not be blank")
+        return value
+
+class JournalSummary(JournalNarrative):
+    mood: str = Field(min_length=1)
+    sentiment_score: float = 0.0
+
+    @field_validator("mood")
+    @classmethod
+    def one_word_mood(cls, value: str) -> str:
+        words = value.split()
+        if not words:
+            raise ValueError("must not be blank")
+        return words[0][:50]
+
+    @field_validator("sentiment_score")
+    @classmethod
+    def clamp_score(cls, value: float) -> float:
+        return max(-1.0, min(1.0, value))
@@ -0,0 +1,194 @@
+from typing import List, Optional, Tuple
+from uuid import UUID
+import base64, html, json, re
+
+from sqlalchemy import column, delete, func, insert, literal, literal_column, select, table, text
+from sqlalchemy.orm import Session
+
+from .models import Conversation, JournalEntry, Message, SearchDocument
+
+SEARCH_LANGUAGE = "english"
+HIGHLIGHT_START, HIGHLIGHT_STOP = "<mark>", "</mark>"
+# The database highlights with private-use characters; the snippet is HTML escaped
+# before they become <mark> tags, so stored text never reaches a client as markup
+SENTINEL_START, SENTINEL_STOP = "\ue000", "\ue001"
+SNIPPET_TOKENS = 24
+
+# Postgres ranks with ts_rank_cd normalised to 0..1, SQLite with negated bm25;
+# both are "higher is better" so the same keyset cursor works on either backend
+FTS_TABLE = table("search_documents_fts", column("rowid"))
+SEARCH_VECTOR = literal_column("search_documents.search_vector")
+HIT_COLUMNS = (
+    SearchDocument.search_id,
+    SearchDocument.doc_id,
+    SearchDocument.kind,
+    SearchDocument.cid.label("cid"),
+    SearchDocument.role,
+    SearchDocument.create_time,
+)
+
+# FTS5 query syntax is not safe to pass through, user input is reduced to quoted terms
+FTS5_TERM = re.compile(r"\w+", re.UNICODE)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+class SearchUnavailable(Exception):
+    pass
+
+
+def render_snippet(snippet: Optional[str]) -> Optional[str]:
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(SENTINEL_START, HIGHLIGHT_START).replace(SENTINEL_STOP, HIGHLIGHT_STOP)
+
+def encode_cursor(score: float, search_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([score, search_id]).encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        score, search_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), int(search_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor("Malformed search cursor") from e
+
+
+### Index maintenance, called from crud inside the caller's transaction
+
+def index_message(db: Session, message: Message, user_id: UUID):
+    db.add(SearchDocument(
+        doc_id=message.msg_id,
+        uid=user_id,
+        kind="message",
+        cid=message.cid,
+        role=message.role,
+        content=message.content,
+        create_time=message.create_time,
+        embed_pending=message.role == "user",
+    ))
+
+def index_journal(db: Session, journal_entry: JournalEntry):
+    db.add(SearchDocument(
+        doc_id=journal_entry.journal_id,
+        uid=journal_entry.uid,
+        kind="journal",
+        cid=journal_entry.cid,
+        content=journal_entry.content,
+        create_time=journal_entry.create_time,
+        embed_pending=True,
+    ))
+
+def reindex_journal(db: Session, journal_entry: JournalEntry):
+    # Re-inserted rather than updated, the new search_id tells the semantic indexer
+    # that an embedding computed from the old content is stale
+    remove_document(db, journal_entry.journal_id)
+    index_journal(db, journal_entry)
+
+def remove_document(db: Session, doc_id: UUID):
+    db.execute(delete(SearchDocument).where(SearchDocument.doc_id == doc_id))
+
+def remove_conversation(db: Session, conversation_id: UUID):
+    db.execute(
+        delete(SearchDocument)
+        .where(SearchDocument.cid == conversation_id, SearchDocument.kind == "message")
+    )
+
+def rebuild_user_index(db: Session, user_id: UUID):
+    """Re-creates a user's search documents with two INSERT ... SELECT statements."""
+    db.execute(delete(SearchDocument).where(SearchDocument.uid == user_id))
+
+    columns = [
+        SearchDocument.doc_id, SearchDocument.uid, SearchDocument.kind, SearchDocument.cid,
+        SearchDocument.role, SearchDocument.content, SearchDocument.create_time, SearchDocument.embed_pending,
+    ]
+    messages = (
+        select(Message.msg_id, Conversation.uid, literal("message"), Message.cid, Message.role, Message.content, Message.create_time, Message.role == "user")
+        .join(Conversation, Message.cid == Conversation.id)
+        .where(Conversation.uid == user_id)
+    )
+    journals = (
+        select(JournalEntry.journal_id, JournalEntry.uid, literal("journal"), JournalEntry.cid, literal(None), JournalEntry.content, JournalEntry.create_time, literal(True))
+        .where(JournalEntry.uid == user_id)
+    )
+    indexed = db.execute(insert(SearchDocument).from_select(columns, messages)).rowcount
+    indexed += db.execute(insert(SearchDocument).from_select(columns, journals)).rowcount
+    db.commit()
+    return indexed
+
+
+### Queries
+
+def _postgres_search(user_id: UUID, query: str, kind: Optional[str], after: Optional[Tuple[float, int]], limit: int):
+    tsquery = func.websearch_to_tsquery(SEARCH_LANGUAGE, query)
+    score = func.ts_rank_cd(SEARCH_VECTOR, tsquery, 32)
+    page = (
+        select(*HIT_COLUMNS, SearchDocument.content, score.label("score"))
+        .where(SearchDocument.uid == user_id, SEARCH_VECTOR.op("@@")(tsquery))
+    )
+    if kind:
+        page = page.where(SearchDocument.kind == kind)
+    if after:
+        page = page.where((score < after[0]) | ((score == after[0]) & (SearchDocument.search_id < after[1])))
+    page = page.order_by(score.desc(), SearchDocument.search_id.desc()).limit(limit).subquery()
+
+    # Headlines are the expensive part, only build them for the returned page
+    options = f"StartSel={SENTINEL_START}, StopSel={SENTINEL_STOP}, MaxWords={SNIPPET_TOKENS * 2}, MinWords={SNIPPET_TOKENS // 2}"
+    snippet = func.ts_headline(SEARCH_LANGUAGE, page.c.content, tsquery, options)
+    return (
+        select(*[c for c in page.c if c.name != "content"], snippet.label("snippet"))
+        .order_by(page.c.score.desc(), page.c.search_id.desc())
+    )
+
+def _sqlite_search(user_id: UUID, query: str, kind: Optional[str], after: Optional[Tuple[float, int]], limit: int):
+    terms = FTS5_TERM.findall(query)
+    if not terms:
+        return None
+
+    match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+    score = -func.bm25(literal_column("search_documents_fts"))
+    snippet = func.snippet(literal_column("search_documents_fts"), 0, SENTINEL_START, SENTINEL_STOP, "…", SNIPPET_TOKENS)
+    statement = (
+        select(*HIT_COLUMNS, score.label("score"), snippet.label("snippet"))
+        .select_from(FTS_TABLE)
+        .join(SearchDocument, SearchDocument.search_id == FTS_TABLE.c.rowid)
+        .where(text("search_documents_fts MATCH :match").bindparams(match=match), SearchDocument.uid == user_id)
+    )
+    if kind:
+        statement = statement.where(SearchDocument.kind == kind)
+    if after:
+        statement = statement.where((score < after[0]) | ((score == after[0]) & (SearchDocument.search_id < after[1])))
+    return statement.order_by(score.desc(), SearchDocument.search_id.desc()).limit(limit)
+
+SEARCH_BACKENDS = {
+    "postgresql": _postgres_search,
+    "sqlite": _sqlite_search,
+}
+
+def search(db: Session, user_id: UUID, query: str, kind: Optional[str] = None, cursor: Optional[str] = None, limit: int = 20):
+    """
+    Ranked, highlighted full-text search over one user's messages and journals.
+    Returns the hits and a cursor for the next page, None when there are no more.
+    """
+    dialect = db.get_bind().dialect.name
+    backend = SEARCH_BACKENDS.get(dialect)
+    if backend is None:
+        raise SearchUnavailable(f"Full-text search is not available on {dialect}")
+
+    after = decode_cursor(cursor) if cursor else None
+    statement = backend(user_id, query, kind, after, limit + 1)
+    rows = db.execute(statement).all() if statement is not None else []
+
+    hits: List[dict] = [
+        {
+            "id": row.doc_id,
+            "kind": row.kind,
+            "cid": row.cid,
+            "role": row.role,
+            "create_time": row.create_time,
+            "score": float(row.score),
+            "snippet": render_snippet(row.snippet),
+        } for row in rows[:limit]
+    ]
+    next_cursor = encode_cursor(float(rows[limit - 1].score), rows[limit - 1].search_id) if len(rows) > limit else None
+    return hits, next_cursor
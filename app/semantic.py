@@ -0,0 +1,282 @@
+from datetime import datetime
+from typing import List, Optional, Sequence
+from uuid import UUID
+import asyncio, logging, os
+
+import httpx
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_ollama import OllamaEmbeddings
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+
+from .assistant import LLMLimiter, llm_limiter, ollama_url
+from .database import SessionLocal
+from .metrics import SEMANTIC_INDEXED
+from .models import SearchDocument, SemanticVector
+from .tracing import TracedEmbeddings
+
+logger = logging.getLogger("semantic")
+
+SEMANTIC_INDEX_ENABLED = os.getenv("SEMANTIC_INDEX_ENABLED", "true").lower() == "true"
+SEMANTIC_EMBED_MODEL = os.getenv("SEMANTIC_EMBED_MODEL", "llama3.1")
+SEMANTIC_INDEX_BATCH = int(os.getenv("SEMANTIC_INDEX_BATCH", "32"))
+SEMANTIC_INDEX_POLL_SECONDS = float(os.getenv("SEMANTIC_INDEX_POLL_SECONDS", "5"))
+# Long journals are embedded from their opening, which is where the summary sits
+SEMANTIC_MAX_CHARS = int(os.getenv("SEMANTIC_MAX_CHARS", "2000"))
+SEMANTIC_MAX_ATTEMPTS = int(os.getenv("SEMANTIC_MAX_ATTEMPTS", "3"))
+
+# Failures of the embedding service itself; they stop the pass without counting
+# against the documents, which are retried on the next poll
+TRANSIENT_ERRORS = (httpx.TransportError, ConnectionError, asyncio.TimeoutError)
+
+
+def quantize(vectors: np.ndarray):
+    """Unit-normalises each row and maps it to int8 with a per-row scale."""
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales
+
+
+### Index maintenance, called from crud inside the caller's transaction
+
+def remove_document(db: Session, doc_id: UUID):
+    db.execute(delete(SemanticVector).where(SemanticVector.doc_id == doc_id))
+
+def remove_conversation(db: Session, conversation_id: UUID):
+    db.execute(
+        delete(SemanticVector)
+        .where(SemanticVector.cid == conversation_id, SemanticVector.kind == "message")
+    )
+
+def remove_user(db: Session, user_id: UUID):
+    db.execute(delete(SemanticVector).where(SemanticVector.uid == user_id))
+
+def reset_user(db: Session, user_id: UUID):
+    """Drops a user's vectors and queues all of their documents for embedding again."""
+    remove_user(db, user_id)
+    db.execute(
+        update(SearchDocument)
+        .where(
+            SearchDocument.uid == user_id,
+            (SearchDocument.kind == "journal") | (SearchDocument.role == "user"),
+        )
+        .values(embed_pending=True, embed_attempts=0)
+    )
+    db.commit()
+
+
+### Queries
+
+def semantic_search(
+    db: Session,
+    user_id: UUID,
+    query_vector: Sequence[float],
+    top_k: int = 10,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    kind: Optional[str] = None
+):
+    """Cosine top-k over one user's vectors, dequantized on the fly."""
+    statement = (
+        select(SemanticVector.doc_id, SemanticVector.scale, SemanticVector.vector)
+        .where(SemanticVector.uid == user_id, SemanticVector.model == SEMANTIC_EMBED_MODEL)
+    )
+    if start:
+        statement = statement.where(SemanticVector.create_time >= start)
+    if end:
+        statement = statement.where(SemanticVector.create_time < end)
+    if kind:
+        statement = statement.where(SemanticVector.kind == kind)
+
+    rows = db.execute(statement).all()
+    if not rows:
+        return []
+
+    query = np.asarray(query_vector, dtype=np.float32)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+    matrix = np.frombuffer(b"".join(row.vector for row in rows), dtype=np.int8).reshape(len(rows), -1)
+    if matrix.shape[1] != query.shape[0]:
+        logger.warning("user=%s vectors have %d dimensions, query has %d; rebuild the index", user_id, matrix.shape[1], query.shape[0])
+        return []
+
+    scales = np.fromiter((row.scale for row in rows), dtype=np.float32, count=len(rows))
+    scores = (matrix.astype(np.float32) @ query) * scales
+
+    top_k = min(top_k, len(rows))
+    top = np.argpartition(-scores, top_k - 1)[:top_k]
+    top = top[np.argsort(-scores[top])]
+    scored = {rows[i].doc_id: float(scores[i]) for i in top}
+
+    documents = db.query(SearchDocument).filter(SearchDocument.uid == user_id, SearchDocument.doc_id.in_(scored))
+    hits = [
+        {
+            "id": doc.doc_id,
+            "kind": doc.kind,
+            "cid": doc.cid,
+            "role": doc.role,
+            "create_time": doc.create_time,
+            "score": round(scored[doc.doc_id], 4),
+            "content": doc.content,
+        } for doc in documents
+    ]
+    return sorted(hits, key=lambda hit: hit["score"], reverse=True)
+
+
+class SemanticIndexer:
+    """
+    Embeds search documents in the background.
+
+    The write path only flags rows in search_documents as embed_pending, so saving a
+    message costs nothing extra. A single worker polls for pending rows in batches and
+    embeds them whenever no chat generation is waiting for an LLM slot, then stores the
+    quantized vectors and clears the flag in one transaction. A journal edited while its
+    old content was being embedded is re-inserted with a new search_id, so the stale
+    vector is replaced on the next pass.
+
+    When a batch is rejected its documents are embedded one by one. Each document that
+    still fails has an attempt counted, is retried after fresh documents, and is left
+    unindexed after SEMANTIC_MAX_ATTEMPTS.
+    """
+
+    def __init__(self, embeddings: Embeddings, limiter: LLMLimiter = llm_limiter):
+        self.embeddings = embeddings
+        self.limiter = limiter
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None
+
+    def start(self):
+        if not SEMANTIC_INDEX_ENABLED or self.running:
+            return
+        self.task = asyncio.create_task(self._run(), name="semantic-indexer")
+        logger.info("Semantic indexer started model=%s batch=%d", SEMANTIC_EMBED_MODEL, SEMANTIC_INDEX_BATCH)
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+
+    async def _run(self):
+        while True:
+            try:
+                indexed = await self.index_pending()
+                if indexed:
+                    logger.info("Embedded %d documents", indexed)
+            except Exception as e:
+                logger.error("Semantic indexing failed: %s", e)
+
+            await asyncio.sleep(SEMANTIC_INDEX_POLL_SECONDS)
+
+    async def index_pending(self, user_id: Optional[UUID] = None, yield_to_chat: bool = True) -> int:
+        """Embeds pending documents until none are left; returns how many were stored."""
+        total = 0
+        while True:
+            batch = await asyncio.to_thread(self._load_pending, user_id)
+            if not batch:
+                return total
+
+            if yield_to_chat:
+                await self._wait_for_idle_chat()
+            try:
+                vectors = await self.embeddings.aembed_documents([doc.content[:SEMANTIC_MAX_CHARS] for doc in batch])
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception as e:
+                logger.warning("Embedding a batch of %d documents failed, retrying one by one: %s", len(batch), e)
+                # Failed documents are retried on a later poll rather than right away
+                return total + await self._index_one_by_one(batch)
+            total += await asyncio.to_thread(self._store, batch, vectors)
+
+    async def _index_one_by_one(self, batch: List[SearchDocument]) -> int:
+        embedded, vectors, failed = [], [], []
+        for doc in batch:
+            try:
+                vectors.append(await self.embeddings.aembed_query(doc.content[:SEMANTIC_MAX_CHARS]))
+                embedded.append(doc)
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception as e:
+                logger.warning("search_id=%d embedding failed: %s", doc.search_id, e)
+                failed.append(doc)
+
+        if failed:
+            await asyncio.to_thread(self._record_failures, failed)
+        return await asyncio.to_thread(self._store, embedded, vectors) if embedded else 0
+
+    async def _wait_for_idle_chat(self):
+        while self.limiter.load()[0] > 0:
+            await asyncio.sleep(0.5)
+
+    def _load_pending(self, user_id: Optional[UUID]) -> List[SearchDocument]:
+        with SessionLocal() as db:
+            query = db.query(SearchDocument).filter(SearchDocument.embed_pending.is_(True))
+            if user_id:
+                query = query.filter(SearchDocument.uid == user_id)
+            # Documents that failed before go last, so they cannot hold up new ones
+            batch = query.order_by(SearchDocument.embed_attempts, SearchDocument.search_id).limit(SEMANTIC_INDEX_BATCH).all()
+            db.expunge_all()
+            return batch
+
+    def _record_failures(self, failed: List[SearchDocument]):
+        search_ids = [doc.search_id for doc in failed]
+        with SessionLocal() as db:
+            db.execute(
+                update(SearchDocument)
+                .where(SearchDocument.search_id.in_(search_ids))
+                .values(embed_attempts=SearchDocument.embed_attempts + 1)
+            )
+            given_up = db.scalars(
+                update(SearchDocument)
+                .where(SearchDocument.search_id.in_(search_ids), SearchDocument.embed_attempts >= SEMANTIC_MAX_ATTEMPTS)
+                .values(embed_pending=False)
+                .returning(SearchDocument.search_id)
+            ).all()
+            db.commit()
+
+        if given_up:
+            logger.error("Gave up embedding search_ids=%s after %d attempts", given_up, SEMANTIC_MAX_ATTEMPTS)
+
+    def _store(self, batch: List[SearchDocument], vectors: List[List[float]]) -> int:
+        quantized, scales = quantize(np.asarray(vectors, dtype=np.float32))
+        search_ids = [doc.search_id for doc in batch]
+
+        with SessionLocal() as db:
+            # Documents deleted or re-inserted while they were being embedded are skipped
+            current = set(db.scalars(
+                select(SearchDocument.search_id)
+                .where(SearchDocument.search_id.in_(search_ids), SearchDocument.embed_pending.is_(True))
+            ))
+            stored = [(doc, vector, scale) for doc, vector, scale in zip(batch, quantized, scales) if doc.search_id in current]
+
+            if stored:
+                db.execute(delete(SemanticVector).where(SemanticVector.doc_id.in_([doc.doc_id for doc, _, _ in stored])))
+                db.add_all(
+                    SemanticVector(
+                        uid=doc.uid,
+                        doc_id=doc.doc_id,
+                        kind=doc.kind,
+                        cid=doc.cid,
+                        create_time=doc.create_time,
+                        model=SEMANTIC_EMBED_MODEL,
+                        scale=float(scale),
+                        vector=vector.tobytes(),
+                    ) for doc, vector, scale in stored
+                )
+            db.execute(
+                update(SearchDocument)
+                .where(SearchDocument.search_id.in_(search_ids))
+                .values(embed_pending=False)
+            )
+            db.commit()
+
+        SEMANTIC_INDEXED.inc(len(stored))
+        return len(stored)
+
+
+semantic_embeddings = TracedEmbeddings(OllamaEmbeddings(base_url=ollama_url, model=SEMANTIC_EMBED_MODEL))
+semantic_indexer = SemanticIndexer(semantic_embeddings)
@@ -0,0 +1,140 @@
+from typing import Dict, List, Sequence, Tuple
+import re
+
+import numpy as np
+
+# Compact valence lexicon on a -3..3 scale; words tied to a mood also vote for it
+LEXICON: Dict[str, Tuple[float, str]] = {
+    # happy
+    "happy": (2.5, "happy"), "glad": (2.0, "happy"), "joy": (2.8, "happy"), "joyful": (2.8, "happy"),
+    "great": (2.2, "happy"), "good": (1.5, "happy"), "amazing": (2.8, "happy"), "awesome": (2.6, "happy"),
+    "excited": (2.4, "happy"), "love": (2.5, "happy"), "loved": (2.3, "happy"), "fun": (2.0, "happy"),
+    "wonderful": (2.7, "happy"), "fantastic": (2.7, "happy"), "proud": (2.1, "happy"), "enjoy": (2.0, "happy"),
+    "enjoyed": (2.0, "happy"), "smile": (1.8, "happy"), "laugh": (1.8, "happy"), "better": (1.4, "happy"),
+    # calm
+    "calm": (1.8, "calm"), "relaxed": (2.0, "calm"), "peaceful": (2.2, "calm"), "rested": (1.6, "calm"),
+    "content": (1.6, "calm"), "okay": (0.6, "calm"), "fine": (0.8, "calm"), "safe": (1.5, "calm"),
+    "comfortable": (1.6, "calm"), "balanced": (1.5, "calm"),
+    # hopeful
+    "hope": (1.8, "hopeful"), "hopeful": (2.1, "hopeful"), "optimistic": (2.2, "hopeful"), "motivated": (2.0, "hopeful"),
+    "confident": (2.1, "hopeful"), "improving": (1.6, "hopeful"), "progress": (1.5, "hopeful"),
+    # grateful
+    "grateful": (2.4, "grateful"), "thankful": (2.3, "grateful"), "thanks": (1.5, "grateful"), "thank": (1.5, "grateful"),
+    "appreciate": (2.0, "grateful"), "blessed": (2.3, "grateful"),
+    # sad
+    "sad": (-2.3, "sad"), "unhappy": (-2.2, "sad"), "depressed": (-2.8, "sad"), "down": (-1.5, "sad"),
+    "miserable": (-2.7, "sad"), "cry": (-2.0, "sad"), "crying": (-2.1, "sad"), "hopeless": (-2.8, "sad"),
+    "empty": (-2.0, "sad"), "hurt": (-2.0, "sad"), "grief": (-2.5, "sad"), "lost": (-1.5, "sad"),
+    "worthless": (-2.8, "sad"), "disappointed": (-2.0, "sad"), "heartbroken": (-2.8, "sad"), "bad": (-1.8, "sad"),
+    "worse": (-1.9, "sad"), "terrible": (-2.5, "sad"), "awful": (-2.5, "sad"),
+    # anxious
+    "anxious": (-2.2, "anxious"), "anxiety": (-2.2, "anxious"), "worried": (-2.0, "anxious"), "worry": (-1.8, "anxious"),
+    "worrying": (-1.9, "anxious"), "nervous": (-1.8, "anxious"), "scared": (-2.2, "anxious"), "afraid": (-2.1, "anxious"),
+    "fear": (-2.2, "anxious"), "panic": (-2.7, "anxious"), "uneasy": (-1.6, "anxious"), "restless": (-1.5, "anxious"),
+    # stressed
+    "stressed": (-2.1, "stressed"), "stress": (-1.9, "stressed"), "overwhelmed": (-2.4, "stressed"), "pressure": (-1.6, "stressed"),
+    "busy": (-0.8, "stressed"), "deadline": (-1.0, "stressed"), "deadlines": (-1.0, "stressed"), "burnout": (-2.5, "stressed"),
+    "struggling": (-2.0, "stressed"), "struggle": (-1.8, "stressed"), "tense": (-1.7, "stressed"),
+    # angry
+    "angry": (-2.3, "angry"), "mad": (-2.0, "angry"), "furious": (-2.8, "angry"), "annoyed": (-1.7, "angry"),
+    "frustrated": (-2.0, "angry"), "irritated": (-1.8, "angry"), "hate": (-2.6, "angry"), "resent": (-2.1, "angry"),
+    # lonely
+    "lonely": (-2.3, "lonely"), "alone": (-1.7, "lonely"), "isolated": (-2.2, "lonely"), "ignored": (-1.9, "lonely"),
+    "abandoned": (-2.5, "lonely"), "rejected": (-2.3, "lonely"),
+    # tired
+    "tired": (-1.5, "tired"), "exhausted": (-2.2, "tired"), "drained": (-2.0, "tired"), "sleepy": (-1.0, "tired"),
+    "insomnia": (-1.9, "tired"), "fatigue": (-1.8, "tired"), "weary": (-1.6, "tired"),
+}
+
+NEGATIONS = {"not", "no", "never", "dont", "don't", "cant", "can't", "isnt", "isn't", "wasnt", "wasn't", "nothing", "hardly", "without"}
+INTENSIFIERS = {"very": 1.5, "so": 1.4, "really": 1.4, "extremely": 1.8, "too": 1.3, "super": 1.5, "incredibly": 1.7, "slightly": 0.6, "little": 0.7}
+NEGATION_WINDOW = 3
+# Negated words flip and dampen, "not sad" is milder than "happy" (VADER's N_SCALAR)
+NEGATION_SCALE = -0.74
+NEUTRAL_MOOD = "neutral"
+
+# Normalisation constant from VADER: maps the raw valence sum into (-1, 1)
+ALPHA = 15.0
+
+# Punctuation is kept as a token so negation does not reach across clauses
+TOKEN_PATTERN = re.compile(r"[a-z']+|[.,!?;:]")
+CLAUSE_BREAKS = set(".,!?;:")
+
+
+class MoodScorer:
+    """
+    CPU only mood and sentiment scorer over a fixed lexicon.
+
+    Texts are tokenized once, lexicon hits are gathered into flat index arrays
+    and all per-text sums are computed with vectorized numpy reductions, so
+    scoring a batch costs one pass over the tokens plus a few array operations.
+    """
+
+    def __init__(self, lexicon: Dict[str, Tuple[float, str]] = LEXICON):
+        self.moods: List[str] = sorted({mood for _, mood in lexicon.values()})
+        mood_index = {mood: i for i, mood in enumerate(self.moods)}
+
+        self.vocab = {word: i for i, word in enumerate(lexicon)}
+        self.valence = np.array([valence for valence, _ in lexicon.values()], dtype=np.float32)
+        self.word_mood = np.array([mood_index[mood] for _, mood in lexicon.values()], dtype=np.int64)
+
+    def score_batch(self, texts: Sequence[str]) -> List[Tuple[str, float]]:
+        n = len(texts)
+        docs, words, weights = [], [], []
+
+        for doc, text in enumerate(texts):
+            tokens = TOKEN_PATTERN.findall(text.lower())
+            for position, token in enumerate(tokens):
+                word = self.vocab.get(token)
+                if word is None:
+                    continue
+
+                weight = 1.0
+                window = tokens[max(position - NEGATION_WINDOW, 0):position]
+                for i in range(len(window) - 1, -1, -1):
+                    if window[i] in CLAUSE_BREAKS:
+                        window = window[i + 1:]
+                        break
+                if window and window[-1] in INTENSIFIERS:
+                    weight = INTENSIFIERS[window[-1]]
+                if any(previous in NEGATIONS for previous in window):
+                    weight *= NEGATION_SCALE
+
+                docs.append(doc)
+                words.append(word)
+                weights.append(weight)
+
+        if not docs:
+            return [(NEUTRAL_MOOD, 0.0)] * n
+
+        docs = np.asarray(docs, dtype=np.int64)
+        words = np.asarray(words, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float32)
+
+        valence = np.bincount(docs, weights=self.valence[words] * weights, minlength=n)
+        scores = valence / np.sqrt(valence * valence + ALPHA)
+
+        # Negated words ("not happy") count towards valence but do not vote for their mood
+        votes = np.zeros((n, len(self.moods)), dtype=np.float32)
+        positive = weights > 0
+        np.add.at(votes, (docs[positive], self.word_mood[words[positive]]), weights[positive])
+
+        best = votes.argmax(axis=1)
+        has_mood = votes.max(axis=1) > 0
+        return [
+            (self.moods[best[i]] if has_mood[i] else NEUTRAL_MOOD, round(float(scores[i]), 4))
+            for i in range(n)
+        ]
+
+    def score(self, text: str) -> Tuple[str, float]:
+        return self.score_batch([text])[0]
+
+
+def rollup_mood(mood_counts: Dict[str, int]) -> str:
+    """Most frequent non neutral mood, falling back to neutral."""
+    moods = {mood: count for mood, count in mood_counts.items() if mood != NEUTRAL_MOOD and count > 0}
+    if not moods:
+        return NEUTRAL_MOOD
+    return max(moods, key=moods.get)
+
+mood_scorer = MoodScorer()
@@ -0,0 +1,207 @@
+from importlib import import_module
+from typing import Callable, Dict, List
+import os, logging
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SpanExporter
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger("tracing")
+
+# Spans are no-ops until setup_tracing() installs a provider
+tracer = trace.get_tracer("mindpal")
+
+
+### Exporters
+
+def _file_exporter() -> SpanExporter:
+    path = os.getenv("TRACING_FILE", "traces.jsonl")
+    # One JSON span per line so the file can be tailed or loaded into a collector later
+    return ConsoleSpanExporter(
+        out=open(path, "a", buffering=1),
+        formatter=lambda span: span.to_json(indent=None) + os.linesep,
+    )
+
+def _otlp_exporter() -> SpanExporter:
+    # Endpoint and headers are read from the standard OTEL_EXPORTER_OTLP_* variables
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    return OTLPSpanExporter()
+
+EXPORTERS: Dict[str, Callable[[], SpanExporter]] = {
+    "console": ConsoleSpanExporter,
+    "file": _file_exporter,
+    "otlp": _otlp_exporter,
+}
+
+def register_exporter(name: str, factory: Callable[[], SpanExporter]):
+    EXPORTERS[name] = factory
+
+def _make_exporter(name: str) -> SpanExporter:
+    if name in EXPORTERS:
+        return EXPORTERS[name]()
+
+    # Allow custom exporters as "package.module:factory"
+    module_name, _, attr = name.partition(":")
+    if not attr:
+        raise ValueError(f"Unknown tracing exporter: {name}")
+    return getattr(import_module(module_name), attr)()
+
+def setup_tracing():
+    exporter_name = os.getenv("TRACING_EXPORTER", "none").strip().lower()
+    if exporter_name in ("", "none"):
+        logger.info("Tracing disabled")
+        return
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", "mindpal-webserver")}),
+        sampler=ParentBased(TraceIdRatioBased(float(os.getenv("TRACING_SAMPLE_RATIO", "1.0")))),
+    )
+    provider.add_span_processor(BatchSpanProcessor(_make_exporter(exporter_name)))
+    trace.set_tracer_provider(provider)
+    logger.info("Tracing enabled with exporter=%s", exporter_name)
+
+
+### Instrumentation
+
+class TracingMiddleware:
+    """Opens a server span per HTTP request, named after the matched route template."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with tracer.start_as_current_span(f"HTTP {scope['method']}", kind=SpanKind.SERVER) as span:
+            span.set_attribute("http.method", scope["method"])
+            span.set_attribute("http.target", scope["path"])
+
+            async def send_wrapper(message: Message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.status_code", message["status"])
+                    if message["status"] >= 500:
+                        span.set_status(Status(StatusCode.ERROR))
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = getattr(scope.get("route"), "path", None)
+                if route:
+                    span.set_attribute("http.route", route)
+                    span.update_name(f"{scope['method']} {route}")
+
+
+def trace_engine(engine: Engine):
+    """Open a client span around every SQL statement executed on `engine`."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._otel_span = tracer.start_span(
+            "db.query",
+            kind=SpanKind.CLIENT,
+            attributes={"db.system": conn.dialect.name, "db.statement": statement},
+        )
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._otel_span.end()
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        span = getattr(exception_context.execution_context, "_otel_span", None)
+        if span is not None:
+            span.record_exception(exception_context.original_exception)
+            span.set_status(Status(StatusCode.ERROR))
+            span.end()
+
+
+class LLMSpanHandler(BaseCallbackHandler):
+    """LangChain callback that wraps each chat model call in a span with token counts."""
+
+    # Run in the caller's context so spans nest under the active graph node
+    run_inline = True
+
+    def __init__(self):
+        self.spans = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        params = kwargs.get("invocation_params") or {}
+        span = tracer.start_span("llm.chat", kind=SpanKind.CLIENT)
+        span.set_attribute("llm.model", str(params.get("model", "")))
+        self.spans[run_id] = [span, False]
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        entry = self.spans.get(run_id)
+        if entry and not entry[1]:
+            entry[0].add_event("first_token")
+            entry[1] = True
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        entry = self.spans.pop(run_id, None)
+        if not entry:
+            return
+
+        span = entry[0]
+        generation = response.generations[0][0] if response.generations and response.generations[0] else None
+        usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+        info = getattr(generation, "generation_info", None) or {}
+
+        if usage:
+            span.set_attribute("llm.usage.input_tokens", usage.get("input_tokens", 0))
+            span.set_attribute("llm.usage.output_tokens", usage.get("output_tokens", 0))
+        elif "eval_count" in info:
+            span.set_attribute("llm.usage.input_tokens", info.get("prompt_eval_count", 0))
+            span.set_attribute("llm.usage.output_tokens", info.get("eval_count", 0))
+        span.end()
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        entry = self.spans.pop(run_id, None)
+        if entry:
+            entry[0].record_exception(error)
+            entry[0].set_status(Status(StatusCode.ERROR))
+            entry[0].end()
+
+
+class TracedEmbeddings(Embeddings):
+    """Wraps an embeddings model so every embedding request gets its own span."""
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def _span(self, texts: List[str]):
+        return tracer.start_as_current_span(
+            "llm.embed",
+            kind=SpanKind.CLIENT,
+            attributes={
+                "llm.model": str(getattr(self.embeddings, "model", "")),
+                "embedding.batch_size": len(texts),
+                "embedding.input_chars": sum(len(text) for text in texts),
+            },
+        )
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self._span(texts):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self._span([text]):
+            return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self._span(texts):
+            return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        with self._span([text]):
+            return await self.embeddings.aembed_query(text)
@@ -0,0 +1,346 @@
+"""
+Load test driver for the MindPal web server.
+
+Virtual users register, log in and open a conversation, then run a weighted
+mix of streaming chat turns, history reads, conversation listings and journal
+generation. Concurrency is stepped up and every step reports throughput and
+p50/p95/p99 end-to-end latency (plus time-to-first-token for chat turns).
+
+Run against an already running server:
+
+    python -m benchmarks.loadtest --base-url http://127.0.0.1:8000
+
+or let the driver start a stub Ollama and a server backed by SQLite:
+
+    python -m benchmarks.loadtest --spawn --concurrency 1,4,16 --duration 30
+
+Use --save-baseline to store the report and --baseline to flag regressions
+against it; the exit status is 1 when a regression is found.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List
+from uuid import uuid4
+import argparse, asyncio, json, os, random, socket, subprocess, sys, tempfile, time
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DEFAULT_MIX = "chat=0.55,history=0.2,conversations=0.12,start=0.05,journal=0.05,login=0.03"
+QUESTIONS = [
+    "I have been feeling overwhelmed at work lately.",
+    "How can I calm down before an exam?",
+    "I can't sleep well, any advice?",
+    "Today was actually a pretty good day.",
+    "I keep worrying about things I cannot control.",
+]
+
+
+class Stats:
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.ttft: List[float] = []
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, op: str, seconds: float):
+        self.latency[op].append(seconds)
+
+    def report(self, elapsed: float) -> dict:
+        ops = {}
+        for op in sorted(set(self.latency) | set(self.errors)):
+            samples = self.latency.get(op, [])
+            ops[op] = {
+                "count": len(samples),
+                "errors": self.errors.get(op, 0),
+                "throughput": len(samples) / elapsed if elapsed else 0.0,
+                **percentiles(samples),
+            }
+        if self.ttft:
+            ops["chat"]["ttft"] = percentiles(self.ttft)
+
+        total = sum(len(samples) for samples in self.latency.values())
+        return {"elapsed": elapsed, "throughput": total / elapsed if elapsed else 0.0, "ops": ops}
+
+
+def percentiles(samples: List[float]) -> dict:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+
+    ordered = sorted(samples)
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99)}
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+### Virtual user
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, stats: Stats, rng: random.Random):
+        self.client = client
+        self.stats = stats
+        self.rng = rng
+        self.headers = {}
+        self.conversations = []
+
+    @contextmanager
+    def timed(self, op: str):
+        start = perf_counter()
+        try:
+            yield
+        except Exception:
+            self.stats.errors[op] += 1
+        else:
+            self.stats.record(op, perf_counter() - start)
+
+    async def setup(self):
+        self.credentials = {"email": f"bench-{uuid4().hex}@example.com", "password": "benchmark-password"}
+
+        with self.timed("register"):
+            response = await self.client.post("/auth/register", json={**self.credentials, "name": "Bench", "dob": "1990-01-01"})
+            response.raise_for_status()
+
+        await self.login()
+        await self.start()
+
+    async def login(self):
+        with self.timed("login"):
+            response = await self.client.post("/auth/login", json=self.credentials)
+            response.raise_for_status()
+            self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def start(self):
+        with self.timed("start"):
+            response = await self.client.get("/chat/start", headers=self.headers)
+            response.raise_for_status()
+            self.conversations.append(response.json())
+
+    async def chat(self):
+        conversation_id = self.rng.choice(self.conversations)
+        start = perf_counter()
+        first = None
+        with self.timed("chat"):
+            async with self.client.stream(
+                "POST",
+                f"/chat/{conversation_id}/message",
+                json={"role": "user", "content": self.rng.choice(QUESTIONS)},
+                headers=self.headers,
+            ) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_raw():
+                    if chunk and first is None:
+                        first = perf_counter() - start
+        if first is not None:
+            self.stats.ttft.append(first)
+
+    async def history(self):
+        with self.timed("history"):
+            response = await self.client.get(f"/chat/{self.rng.choice(self.conversations)}", headers=self.headers)
+            response.raise_for_status()
+
+    async def list_conversations(self):
+        with self.timed("conversations"):
+            response = await self.client.get("/chat/conversations", params={"limit": 10, "offset": 0}, headers=self.headers)
+            response.raise_for_status()
+
+    async def journal(self):
+        with self.timed("journal"):
+            response = await self.client.get("/journal/generate_missing", headers=self.headers)
+            response.raise_for_status()
+
+    async def run(self, mix: Dict[str, float], deadline: float):
+        actions = {
+            "chat": self.chat,
+            "history": self.history,
+            "conversations": self.list_conversations,
+            "start": self.start,
+            "journal": self.journal,
+            "login": self.login,
+        }
+        names = [name for name in mix if name in actions]
+        weights = [mix[name] for name in names]
+
+        while perf_counter() < deadline:
+            await actions[self.rng.choices(names, weights)[0]]()
+
+
+async def run_step(base_url: str, concurrency: int, duration: float, mix: Dict[str, float], seed: int) -> dict:
+    setup_stats, stats = Stats(), Stats()
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        users = [VirtualUser(client, setup_stats, random.Random(seed + index)) for index in range(concurrency)]
+        start = perf_counter()
+        await asyncio.gather(*(user.setup() for user in users))
+        setup_elapsed = perf_counter() - start
+
+        # Only the steady state mix counts towards throughput
+        users = [user for user in users if user.conversations]
+        for user in users:
+            user.stats = stats
+
+        start = perf_counter()
+        await asyncio.gather(*(user.run(mix, start + duration) for user in users))
+        elapsed = perf_counter() - start
+
+    return {**stats.report(elapsed), "setup": setup_stats.report(setup_elapsed)["ops"]}
+
+
+### Baseline comparison
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    regressions = []
+    for step, result in report["steps"].items():
+        base_step = baseline.get("steps", {}).get(step)
+        if not base_step:
+            continue
+
+        if result["throughput"] < base_step["throughput"] * (1 - tolerance):
+            regressions.append(f"c={step} throughput {result['throughput']:.2f}/s < baseline {base_step['throughput']:.2f}/s")
+
+        for op, numbers in result["ops"].items():
+            base_op = base_step["ops"].get(op)
+            if not base_op:
+                continue
+            checks = [("p95", numbers, base_op), ("p99", numbers, base_op)]
+            if "ttft" in numbers and "ttft" in base_op:
+                checks.append(("ttft p95", numbers["ttft"], base_op["ttft"]))
+
+            for label, current, previous in checks:
+                key = label.split()[-1]
+                if current.get(key) is None or previous.get(key) is None:
+                    continue
+                if current[key] > previous[key] * (1 + tolerance):
+                    regressions.append(f"c={step} {op} {label} {current[key] * 1000:.1f}ms > baseline {previous[key] * 1000:.1f}ms")
+    return regressions
+
+def print_report(report: dict):
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:8.1f}"
+
+    for step, result in report["steps"].items():
+        print(f"\nconcurrency={step} throughput={result['throughput']:.2f} req/s")
+        print(f"  {'op':<14}{'count':>7}{'err':>5}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        ops = {**{f"setup:{op}": numbers for op, numbers in result.get("setup", {}).items()}, **result["ops"]}
+        for op, numbers in ops.items():
+            print(f"  {op:<14}{numbers['count']:>7}{numbers['errors']:>5}{numbers['throughput']:>9.2f}{ms(numbers['p50']):>10}{ms(numbers['p95']):>10}{ms(numbers['p99']):>10}")
+            if "ttft" in numbers:
+                ttft = numbers["ttft"]
+                print(f"  {'  ttft':<14}{'':>21}{ms(ttft['p50']):>10}{ms(ttft['p95']):>10}{ms(ttft['p99']):>10}")
+
+
+### Local stack
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for(url: str, timeout: float = 120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=2)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+@contextmanager
+def spawn_stack(args):
+    workdir = Path(tempfile.mkdtemp(prefix="mindpal-bench-"))
+    stub_port, server_port = free_port(), free_port()
+    env = {
+        **os.environ,
+        "DATABASE_URL": args.database_url or f"sqlite:///{workdir / 'bench.db'}",
+        "OLLAMA_URL": f"http://127.0.0.1:{stub_port}",
+        "FAISS_DIR": str(workdir / "faiss"),
+        "ACCESS_SECRET_KEY": "bench-access",
+        "REFRESH_SECRET_KEY": "bench-refresh",
+        "ALGORITHM": "HS256",
+        "ACCESS_TOKEN_EXPIRE_MINUTES": "60",
+        "REFRESH_TOKEN_EXPIRE_DAYS": "1",
+        "LOG_LEVEL": "WARNING",
+    }
+    processes = []
+    try:
+        processes.append(subprocess.Popen([
+            sys.executable, "-m", "benchmarks.stub_ollama", "--port", str(stub_port),
+            "--ttft-ms", str(args.stub_ttft_ms), "--tokens-per-sec", str(args.stub_tokens_per_sec),
+            "--tokens", str(args.stub_tokens), "--seed", str(args.seed),
+        ], cwd=ROOT, env=env))
+        wait_for(f"http://127.0.0.1:{stub_port}/")
+
+        subprocess.run([sys.executable, "manage.py", "migrate"], cwd=ROOT, env=env, check=True)
+        processes.append(subprocess.Popen([
+            sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(server_port), "--log-level", "warning",
+        ], cwd=ROOT, env=env))
+        wait_for(f"http://127.0.0.1:{server_port}/auth/")
+
+        yield f"http://127.0.0.1:{server_port}"
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MindPal load test")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated concurrency steps")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per concurrency step")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Weighted operation mix")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report to this path")
+    parser.add_argument("--baseline", help="Compare against a stored JSON report")
+    parser.add_argument("--save-baseline", help="Store the JSON report as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative regression")
+    parser.add_argument("--spawn", action="store_true", help="Start a stub Ollama and a local server")
+    parser.add_argument("--database-url", help="Database for --spawn (defaults to a temporary SQLite file)")
+    parser.add_argument("--stub-ttft-ms", type=float, default=200)
+    parser.add_argument("--stub-tokens-per-sec", type=float, default=40)
+    parser.add_argument("--stub-tokens", type=int, default=80)
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    steps = [int(step) for step in args.concurrency.split(",")]
+
+    def run(base_url: str) -> dict:
+        report = {"mix": mix, "duration": args.duration, "steps": {}}
+        for concurrency in steps:
+            report["steps"][str(concurrency)] = asyncio.run(run_step(base_url, concurrency, args.duration, mix, args.seed))
+        return report
+
+    if args.spawn:
+        with spawn_stack(args) as base_url:
+            report = run(base_url)
+    else:
+        report = run(args.base_url)
+
+    print_report(report)
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        Path(path).write_text(json.dumps(report, indent=2))
+
+    if args.baseline:
+        regressions = compare(report, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Stub Ollama server for benchmarks.
+
+Implements the subset of the Ollama HTTP API used by langchain-ollama
+(/api/chat, /api/embed and the legacy /api/embeddings) and emits tokens at a
+configurable latency and rate, so the web server can be load tested without a GPU.
+
+    python -m benchmarks.stub_ollama --port 11435 --ttft-ms 200 --tokens-per-sec 40
+"""
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import argparse, asyncio, hashlib, json, random
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class StubConfig:
+    ttft_ms: float = 200.0
+    jitter_ms: float = 50.0
+    tokens_per_sec: float = 40.0
+    tokens: int = 80
+    embed_ms: float = 20.0
+    embed_dim: int = 768
+    seed: int = 0
+
+config = StubConfig()
+app = FastAPI(title="Stub Ollama")
+
+WORDS = (
+    "it sounds like you have been carrying a lot lately and that is completely "
+    "understandable try to take a slow breath and notice how you feel right now"
+).split()
+
+JOURNAL = {
+    "journal_content": "The user talked about a stressful week and explored ways to rest.",
+    "mood": "Stressed",
+    "sentiment_score": -0.2,
+}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def _wants_json(body: dict) -> bool:
+    if body.get("format"):
+        return True
+    return any("json" in str(msg.get("content", "")).lower() for msg in body.get("messages", []))
+
+def _tokens(body: dict, rng: random.Random):
+    if _wants_json(body):
+        text = json.dumps(JOURNAL)
+        # Split the JSON document into roughly token sized pieces
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+    return [rng.choice(WORDS) + " " for _ in range(config.tokens)]
+
+def _chunk(model: str, content: str, done: bool = False, **extra) -> bytes:
+    payload = {
+        "model": model,
+        "created_at": _now(),
+        "message": {"role": "assistant", "content": content},
+        "done": done,
+        **extra,
+    }
+    return (json.dumps(payload) + "\n").encode()
+
+def _final_stats(prompt_tokens: int, eval_tokens: int, elapsed: float) -> dict:
+    return {
+        "done_reason": "stop",
+        "total_duration": int(elapsed * 1e9),
+        "load_duration": 0,
+        "prompt_eval_count": prompt_tokens,
+        "prompt_eval_duration": int(config.ttft_ms * 1e6),
+        "eval_count": eval_tokens,
+        "eval_duration": int(max(elapsed - config.ttft_ms / 1000, 0) * 1e9),
+    }
+
+def _embedding(text: str) -> list:
+    seed = int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+    vector = np.random.default_rng(seed).standard_normal(config.embed_dim).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+@app.get("/")
+def root():
+    return "Ollama is running"
+
+@app.get("/api/version")
+def version():
+    return {"version": "0.5.7-stub"}
+
+@app.get("/api/tags")
+def tags():
+    return {"models": []}
+
+@app.post("/api/chat")
+async def chat(request: Request):
+    body = await request.json()
+    model = body.get("model", "stub")
+    rng = random.Random(config.seed or None)
+    tokens = _tokens(body, rng)
+    prompt_tokens = sum(len(str(msg.get("content", "")).split()) for msg in body.get("messages", []))
+    delay = 1 / config.tokens_per_sec if config.tokens_per_sec > 0 else 0
+    started = asyncio.get_running_loop().time()
+
+    async def first_token_delay():
+        await asyncio.sleep(max(config.ttft_ms + rng.uniform(-config.jitter_ms, config.jitter_ms), 0) / 1000)
+
+    if not body.get("stream", True):
+        await first_token_delay()
+        await asyncio.sleep(delay * len(tokens))
+        elapsed = asyncio.get_running_loop().time() - started
+        return JSONResponse(json.loads(_chunk(model, "".join(tokens), True, **_final_stats(prompt_tokens, len(tokens), elapsed))))
+
+    async def stream():
+        await first_token_delay()
+        for index, token in enumerate(tokens):
+            if index:
+                await asyncio.sleep(delay)
+            yield _chunk(model, token)
+        elapsed = asyncio.get_running_loop().time() - started
+        yield _chunk(model, "", True, **_final_stats(prompt_tokens, len(tokens), elapsed))
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.post("/api/embed")
+async def embed(request: Request):
+    body = await request.json()
+    inputs = body.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+
+    await asyncio.sleep(config.embed_ms / 1000)
+    return {"model": body.get("model", "stub"), "embeddings": [_embedding(text) for text in inputs]}
+
+@app.post("/api/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    await asyncio.sleep(config.embed_ms / 1000)
+    return {"embedding": _embedding(body.get("prompt", ""))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub Ollama server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--ttft-ms", type=float, default=config.ttft_ms, help="Latency before the first token")
+    parser.add_argument("--jitter-ms", type=float, default=config.jitter_ms, help="Uniform jitter applied to the first token latency")
+    parser.add_argument("--tokens-per-sec", type=float, default=config.tokens_per_sec, help="Decode rate of streamed tokens")
+    parser.add_argument("--tokens", type=int, default=config.tokens, help="Tokens per chat response")
+    parser.add_argument("--embed-ms", type=float, default=config.embed_ms, help="Latency of one embedding request")
+    parser.add_argument("--embed-dim", type=int, default=config.embed_dim, help="Embedding dimensions")
+    parser.add_argument("--seed", type=int, default=config.seed, help="Fixed seed for token selection (0 = random)")
+    args = parser.parse_args()
+
+    for field in ("ttft_ms", "jitter_ms", "tokens_per_sec", "tokens", "embed_ms", "embed_dim", "seed"):
+        setattr(config, field, getattr(args, field))
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
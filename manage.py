@@ -0,0 +1,86 @@
+import argparse, asyncio
+from uuid import UUID
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+from app import crud
+from app.analytics import rebuild_user_rollups
+from app.search import rebuild_user_index
+from app.semantic import reset_user, semantic_indexer
+from app.database import Base, SessionLocal, engine
+from app.models import User
+
+
+def migrate(args):
+    Base.metadata.create_all(bind=engine)
+    print("Database schemas are created successfully")
+
+
+def backfill_rollups(args):
+    with SessionLocal() as db:
+        user_ids = [args.user] if args.user else [row.id for row in db.query(User.id).order_by(User.id)]
+        for user_id in user_ids:
+            days = rebuild_user_rollups(db, user_id, args.batch_size)
+            print(f"user={user_id} rebuilt {days} daily rollups")
+
+
+def reindex_search(args):
+    with SessionLocal() as db:
+        user_ids = [args.user] if args.user else [row.id for row in db.query(User.id).order_by(User.id)]
+        for user_id in user_ids:
+            indexed = rebuild_user_index(db, user_id)
+            print(f"user={user_id} indexed {indexed} documents")
+
+
+def rebuild_semantic(args):
+    with SessionLocal() as db:
+        user_ids = [args.user] if args.user else [row.id for row in db.query(User.id).order_by(User.id)]
+        for user_id in user_ids:
+            reset_user(db, user_id)
+
+    async def embed_all():
+        for user_id in user_ids:
+            embedded = await semantic_indexer.index_pending(user_id, yield_to_chat=False)
+            print(f"user={user_id} embedded {embedded} documents")
+
+    asyncio.run(embed_all())
+
+
+def score_messages(args):
+    with SessionLocal() as db:
+        scored = crud.score_unscored_messages(db, args.batch_size)
+        print(f"scored {scored} messages")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MindPal maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = commands.add_parser("migrate", help="Create missing tables and indexes")
+    migrate_parser.set_defaults(func=migrate)
+
+    backfill = commands.add_parser("backfill-rollups", help="Rebuild mood rollups from existing journals")
+    backfill.add_argument("--user", type=UUID, help="Only rebuild this user's rollups")
+    backfill.add_argument("--batch-size", type=int, default=1000)
+    backfill.set_defaults(func=backfill_rollups)
+
+    reindex = commands.add_parser("reindex-search", help="Rebuild the full-text search index from messages and journals")
+    reindex.add_argument("--user", type=UUID, help="Only reindex this user")
+    reindex.set_defaults(func=reindex_search)
+
+    semantic = commands.add_parser("rebuild-semantic", help="Re-embed messages and journals into the semantic index")
+    semantic.add_argument("--user", type=UUID, help="Only rebuild this user's vectors")
+    semantic.set_defaults(func=rebuild_semantic)
+
+    score = commands.add_parser("score-messages", help="Score messages saved before local mood scoring")
+    score.add_argument("--batch-size", type=int, default=500)
+    score.set_defaults(func=score_messages)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,80 @@
 from dotenv import load_dotenv
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from app.database import Base, engine 
-from app.routes import auth, chat, journal
-import uvicorn, os
+load_dotenv(dotenv_path=".env", override=True)
 
+import argparse, glob, logging, os, tempfile, uvicorn
 
-app = FastAPI(title="MindPal Chatbot Server")
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-app.include_router(auth.router)
-app.include_router(chat.router)
-app.include_router(journal.router)
+logger = logging.getLogger("server")
 
-os.environ['LANGSMITH_API_KEY'] = ""
-os.environ['LANGSMITH_ENDPOINT'] = ""
-os.environ['LANGSMITH_PROJECT'] = ""
-os.environ['LANGSMITH_TRACING_V2'] = "true"
-load_dotenv(dotenv_path=".env", override=True)
+# Production defaults, overridable from the environment or the command line
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "2048"))
+# Longer than the idle timeout of the load balancer in front, so it closes idle connections first
+SERVER_KEEPALIVE_SECONDS = int(os.getenv("SERVER_KEEPALIVE_SECONDS", "75"))
+# Chat streams can run for a minute or more, give them time to finish on shutdown
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "90"))
+SERVER_LIMIT_CONCURRENCY = int(os.getenv("SERVER_LIMIT_CONCURRENCY", "0")) or None
 
-if __name__ == "__main__":
-    Base.metadata.create_all(bind=engine)
-    print("Server:", "Database schemas are created successfully")
+def __getattr__(name: str):
+    # `server:app` is resolved in the workers only, so the production supervisor
+    # does not load the models, the vector store and the database engine
+    if name == "app":
+        from app.main import app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def prepare_worker_environment(workers: int):
+    """Settings the worker processes inherit from the supervisor."""
+    if workers > 1:
+        # Workers draw LLM slots from one pool of lock files, so LLM_MAX_CONCURRENCY
+        # holds for the host whatever the worker count
+        os.environ.setdefault("LLM_SLOT_DIR", tempfile.mkdtemp(prefix="mindpal-llm-slots-"))
+
+        metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="mindpal-metrics-"))
+        os.makedirs(metrics_dir, exist_ok=True)
+        # Samples left by a previous run would be summed into the new one
+        for stale in glob.glob(os.path.join(metrics_dir, "*.db")):
+            os.remove(stale)
 
-    uvicorn.run("server:app", host="0.0.0.0", port=8000, reload=True)
+def main():
+    parser = argparse.ArgumentParser(description="Run the MindPal chat server. Create the schema first with `python manage.py migrate`.")
+    parser.add_argument("--prod", action="store_true", default=os.getenv("SERVER_MODE", "development") == "production",
+                        help="Multi-worker production mode (default from SERVER_MODE)")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY") or 0) or os.cpu_count() or 1,
+                        help="Worker processes in production mode (default WEB_CONCURRENCY or one per core)")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    args = parser.parse_args()
+
+    if not args.prod:
+        uvicorn.run("server:app", host=args.host, port=args.port, reload=True)
+        return
+
+    prepare_worker_environment(args.workers)
+    logger.info("Starting %d workers on %s:%d", args.workers, args.host, args.port)
+    uvicorn.run(
+        "server:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop="uvloop",
+        http="httptools",
+        backlog=SERVER_BACKLOG,
+        timeout_keep_alive=SERVER_KEEPALIVE_SECONDS,
+        timeout_graceful_shutdown=SERVER_GRACEFUL_TIMEOUT,
+        limit_concurrency=SERVER_LIMIT_CONCURRENCY,
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+        access_log=os.getenv("SERVER_ACCESS_LOG", "false").lower() == "true",
+    )
+
+if __name__ == "__main__":
+    main()
 